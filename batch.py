@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+Extract the scene-aligned clips of many videos on a pool of processes
+
+Every video is extracted by one worker process, like headless.py does for a
+single video. The workers send the clips they extracted back to this
+process, which is the only one writing them with common.data_utils.ClipWriter,
+so clips are never saved twice. Clips that are already saved are skipped,
+so an interrupted batch continues where it stopped when run again.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import common.data_utils
+import clips
+import headless
+import registry
+import subtitles
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ('.avi', '.m4v', '.mkv', '.mov', '.mp4', '.webm')
+
+# Set in every worker process by init_worker
+results = None
+processed_ids = frozenset()
+
+
+def find_videos(directory):
+    """(video, scene file, subtitle file) for the videos in a directory.
+
+    Scenes are read from <video>.json and subtitles from a subtitle file
+    with the same name as the video, when there are such files.
+    """
+    videos = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.abspath(os.path.join(directory, name))
+        if not name.lower().endswith(VIDEO_EXTENSIONS):
+            continue
+        scene_file = path + '.json'
+        videos.append((path,
+                       scene_file if os.path.isfile(scene_file) else None,
+                       subtitles.find_subtitle_file(path)))
+    return videos
+
+
+def read_manifest(path):
+    """(video, scene file, subtitle file) for every line of a manifest.
+
+    Every line has a video, optionally followed by its ffprobe scene file
+    and subtitle file, separated by tabs. Relative paths are relative to
+    the manifest. Empty lines and lines starting with # are ignored.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    videos = []
+    with open(path, encoding='UTF-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [os.path.join(directory, field) if field else None
+                      for field in line.split('\t')[:3]]
+            fields += [None] * (3 - len(fields))
+            if fields[1] is None and os.path.isfile(fields[0] + '.json'):
+                fields[1] = fields[0] + '.json'
+            videos.append(tuple(fields))
+    return videos
+
+
+def unique_videos(videos):
+    """Skip videos whose clip ids would collide with an earlier video."""
+    keys = {}
+    for video in videos:
+        key = clips.clip_id(video[0], '')
+        if key in keys:
+            logger.warning("Skipping %s: its clip ids are the same as for %s",
+                           video[0], keys[key])
+            continue
+        keys[key] = video[0]
+        yield video
+
+
+def init_worker(result_queue, ids):
+    global results, processed_ids
+    results = result_queue
+    processed_ids = ids
+
+
+def extract_video(video, config, options):
+    """Extract one video in a worker process, reporting to the results."""
+    filename, scene_file, subtitle_file = video
+
+    def save(job):
+        results.put(('clips', filename,
+                     [clip for clip, frames in job.extracted()],
+                     len(job.clips)))
+
+    def planned(count):
+        results.put(('planned', filename, count))
+
+    try:
+        headless.extract(filename, config, save, scene_file, subtitle_file,
+                         processed_ids=processed_ids, planned=planned,
+                         **options)
+        results.put(('done', filename, None))
+    except Exception as e:
+        logger.exception("Extraction failed for %s", filename)
+        results.put(('done', filename, str(e)))
+
+
+class Progress:
+    """Counts of the whole batch, logged whenever they change."""
+
+    def __init__(self, videos):
+        self.videos = videos
+        self.finished = {}
+        self.planned = {}
+        self.saved = 0
+        self.failed = 0
+        self.started = time.time()
+
+    def log(self, filename):
+        elapsed = time.time() - self.started
+        logger.info(
+            "[%d/%d videos] %d of %d clips saved, %d failed, %.1f clips/s "
+            "(%s)", len(self.finished), self.videos, self.saved,
+            sum(self.planned.values()), self.failed,
+            self.saved / elapsed if elapsed else 0.0,
+            os.path.basename(filename))
+
+
+def run(videos, config_file='config.json', processes=None, scale=4.5,
+        split_sub_lines=False, workers=1, batch_size=16, subtitle_stream=0):
+    with open(config_file) as f:
+        config = json.load(f)
+
+    videos = list(unique_videos(videos))
+    processed = registry.ClipRegistry(common.data_utils.get_clip_ids)
+    processed.load_ids()
+
+    options = {
+        'subtitle_stream': subtitle_stream,
+        'scale': scale,
+        'split_sub_lines': split_sub_lines,
+        'workers': workers,
+        'batch_size': batch_size
+    }
+    progress = Progress(len(videos))
+    result_queue = multiprocessing.Queue()
+    writer = common.data_utils.ClipWriter()
+    executor = concurrent.futures.ProcessPoolExecutor(
+        processes, initializer=init_worker,
+        initargs=(result_queue, frozenset(processed.ids)))
+    try:
+        futures = dict((executor.submit(extract_video, video, config,
+                                        options), video[0])
+                       for video in videos)
+
+        while len(progress.finished) < len(videos):
+            try:
+                message = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                # A worker process that died never reports back
+                for future, filename in futures.items():
+                    if (filename not in progress.finished and future.done()
+                            and future.exception() is not None):
+                        logger.error("Worker for %s stopped: %s", filename,
+                                     future.exception())
+                        progress.finished[filename] = False
+                continue
+
+            kind, filename, value = message[:3]
+            if kind == 'planned':
+                progress.planned[filename] = value
+            elif kind == 'clips':
+                for clip in value:
+                    if clip['id'] in processed:
+                        continue
+                    writer.send(clip)
+                    processed.add(clip['id'])
+                    progress.saved += 1
+                progress.failed += message[3] - len(value)
+            elif kind == 'done':
+                progress.finished[filename] = value is None
+                if value is not None:
+                    logger.error("Could not extract %s: %s", filename, value)
+            progress.log(filename)
+    finally:
+        executor.shutdown(wait=True)
+        writer.close()
+
+    failed = [f for f, ok in progress.finished.items() if not ok]
+    logger.info("Saved %d clips from %d videos in %.0fs, %d videos failed",
+                progress.saved, len(videos) - len(failed),
+                time.time() - progress.started, len(failed))
+    return progress.saved, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('videos', help="directory with the videos, or a "
+                        "manifest listing them")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--processes', type=int,
+                        help="videos extracted at the same time "
+                        "(default: number of cores)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="concurrent ffmpeg extractions per video")
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help="maximum number of clips extracted with one "
+                        "decode")
+    parser.add_argument('--subtitle-stream', type=int, default=0,
+                        help="index of the embedded subtitle track, for "
+                        "videos without a subtitle file")
+    parser.add_argument('--scale', type=float, default=4.5,
+                        help="detection scale stored with every clip")
+    parser.add_argument('--split-sub-lines', action='store_true',
+                        help="only keep the last line of every subtitle")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(processName)s %(levelname)s %(message)s')
+    if os.path.isdir(args.videos):
+        videos = find_videos(args.videos)
+    else:
+        videos = read_manifest(args.videos)
+
+    saved, failed = run(videos, args.config, args.processes, args.scale,
+                        args.split_sub_lines, args.workers, args.batch_size,
+                        args.subtitle_stream)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
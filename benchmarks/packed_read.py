@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Read benchmark: frames from one file per frame versus a packed store
+
+Writes synthetic clips as image sequences, packs them with packstore and
+reads every frame back both ways. Every frame is checksummed so both
+readers touch all bytes.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import packstore  # noqa: E402
+
+
+def write_clips(image_root, clips, frames, frame_size):
+    for clip in range(clips):
+        for number in range(1, frames + 1):
+            path = os.path.join(image_root, 'bench{0}-{1:06d}.png'.format(
+                clip, number))
+            with open(path, 'wb') as f:
+                f.write(os.urandom(frame_size))
+
+
+def read_files(image_root):
+    checksum = 0
+    for id, paths in sorted(packstore.frame_files(image_root).items()):
+        for path in paths:
+            with open(path, 'rb') as f:
+                checksum = zlib.crc32(f.read(), checksum)
+    return checksum
+
+
+def read_store(store_path):
+    checksum = 0
+    store = packstore.PackedFrameStore(store_path)
+    for id in sorted(store.ids()):
+        frames = store.frames(id)
+        for frame in frames:
+            checksum = zlib.crc32(frame, checksum)
+        frame = frames = None  # Release the views before closing
+    store.close()
+    return checksum
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clips', type=int, default=200)
+    parser.add_argument('--frames', type=int, default=50,
+                        help="frames per clip")
+    parser.add_argument('--frame-size', type=int, default=64 * 1024,
+                        help="bytes per frame")
+    parser.add_argument('--dir', help="where to write the test data "
+                        "(default: a temporary directory)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    try:
+        image_root = os.path.join(root, 'images')
+        os.makedirs(image_root)
+        write_clips(image_root, args.clips, args.frames, args.frame_size)
+        store_path = os.path.join(root, 'bench.pack')
+        _, pack_time = timed(packstore.convert, image_root, store_path)
+
+        total = args.clips * args.frames
+        megabytes = total * args.frame_size / 1e6
+        print("{0} frames of {1} bytes, packed in {2:.2f}s".format(
+            total, args.frame_size, pack_time))
+
+        files_checksum, files_time = timed(read_files, image_root)
+        store_checksum, store_time = timed(read_store, store_path)
+        assert files_checksum == store_checksum
+
+        for name, seconds in (('files', files_time), ('packed', store_time)):
+            print("{0:>8}: {1:8.0f} frames/s {2:8.1f} MB/s".format(
+                name, total / seconds, megabytes / seconds))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+Startup benchmark: time to import the picker, measured with -X importtime
+
+Fails when a module that should be loaded lazily is imported at startup,
+or when the import time is more than --tolerance above the baseline stored
+in baselines.json. Run with --update to store a new baseline.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines.json')
+
+# Only needed once the window is shown
+LAZY_MODULES = ['tensorflow', 'common.data_utils']
+
+IMPORT_TIME = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)')
+
+
+def measure(module):
+    """Return (total import time in ms, {module: cumulative ms})."""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        check=True)
+
+    total = 0
+    modules = {}
+    for line in process.stderr.decode('UTF-8').splitlines():
+        match = IMPORT_TIME.match(line)
+        if not match:
+            continue
+        cumulative = int(match.group(2)) / 1000.0
+        modules[match.group(4)] = cumulative
+        if len(match.group(3)) == 1:
+            total += cumulative  # Top level import
+    return total, modules
+
+
+def load_baselines():
+    if not os.path.isfile(BASELINES):
+        return {}
+    with open(BASELINES) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--module', default='main')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help="number of slowest imports to list")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown relative to the baseline")
+    parser.add_argument('--update', action='store_true',
+                        help="store the measurement as the new baseline")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    total = statistics.median(run[0] for run in runs)
+    modules = runs[-1][1]
+
+    print("Import time of {0}: {1:.1f} ms (median of {2} runs)".format(
+        args.module, total, args.runs))
+    for name, cumulative in sorted(modules.items(), key=lambda m: -m[1])[
+            :args.top]:
+        print("  {0:8.1f} ms  {1}".format(cumulative, name))
+
+    failed = False
+    for name in LAZY_MODULES:
+        if name in modules:
+            print("FAIL: " + name + " is imported at startup")
+            failed = True
+
+    baselines = load_baselines()
+    key = 'startup.' + args.module
+    if args.update:
+        baselines[key] = {'import_ms': round(total, 1)}
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Stored new baseline")
+    elif key in baselines:
+        limit = baselines[key]['import_ms'] * (1 + args.tolerance)
+        if total > limit:
+            print("FAIL: import time is above {0:.1f} ms".format(limit))
+            failed = True
+    else:
+        print("No baseline stored yet, run with --update to store one")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for scene lookup, the clip registry, picking, saving and extraction
+
+Runs without a display on synthetic data: ffprobe scene files with up to
+millions of frames, sets of clip ids, clips with pose points for the clip
+store (when numpy is installed) and, when ffmpeg is installed, a short test
+video made with its lavfi sources. Every result is compared with the
+baselines in baselines.json, and the run fails when a throughput dropped or
+the memory use grew by more than --tolerance. Run with --update to store
+new baselines.
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import clips  # noqa: E402
+import engine  # noqa: E402
+import extraction  # noqa: E402
+import journal  # noqa: E402
+import registry  # noqa: E402
+import scenes  # noqa: E402
+import subtitles  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines.json')
+
+
+def best_time(function, repeat=3):
+    """Shortest of repeat runs of function, in seconds."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def peak_memory(function):
+    """Peak memory allocated while running function, in kB."""
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak / 1024.0
+
+
+def write_probe_file(path, frames, seconds_per_frame=0.04):
+    """ffprobe -show_frames style JSON with one entry per frame."""
+    with open(path, 'w') as f:
+        f.write('{\n    "frames": [\n')
+        for i in range(frames):
+            f.write('        {\n'
+                    '            "media_type": "video",\n'
+                    '            "key_frame": 1,\n'
+                    '            "pkt_pts_time": "%.6f",\n'
+                    '            "pict_type": "I"\n'
+                    '        }%s\n' % (i * seconds_per_frame,
+                                      ',' if i < frames - 1 else ''))
+        f.write('    ]\n}\n')
+
+
+def bench_scene_index(directory, frames):
+    path = os.path.join(directory, 'scenes-' + str(frames) + '.json')
+    write_probe_file(path, frames)
+    load_time = best_time(lambda: scenes.read_probe_timestamps(path))
+    index = scenes.SceneIndex(scenes.read_probe_timestamps(path))
+    duration = frames * 0.04
+
+    # Playback: every draw looks up a slightly later time
+    count = 200000
+    step = duration / count
+
+    def playback():
+        lookup = index.lookup
+        t = 0.0
+        for _ in range(count):
+            lookup(t)
+            t += step
+
+    # Seeking: every lookup somewhere else
+    targets = [random.uniform(0, duration) for _ in range(count)]
+
+    def seeking():
+        lookup = index.lookup
+        for t in targets:
+            lookup(t)
+
+    return {
+        'load_frames_per_s': frames / load_time,
+        'load_peak_kb': peak_memory(
+            lambda: scenes.SceneIndex(scenes.read_probe_timestamps(path))),
+        'playback_lookups_per_s': count / best_time(playback),
+        'seek_lookups_per_s': count / best_time(seeking),
+    }
+
+
+def synthetic_ids(count):
+    return [clips.clip_id('Show-s01e%02d.mkv' % (i % 100), 1000000 * i)
+            for i in range(count)]
+
+
+def bench_registry(ids):
+    processed = registry.ClipRegistry(lambda: ids)
+    processed.load_ids()
+
+    # Half of the lookups hit, like browsing partly processed videos
+    probes = ids[::2][:100000] + synthetic_ids(200000)[-100000:]
+    random.shuffle(probes)
+
+    def lookups():
+        for id in probes:
+            id in processed
+
+    def load():
+        loaded = registry.ClipRegistry(lambda: ids)
+        loaded.load_ids()
+        return loaded
+
+    return {
+        'lookups_per_s': len(probes) / best_time(lookups),
+        'load_ids_per_s': len(ids) / best_time(load),
+        'peak_kb': peak_memory(load),
+    }
+
+
+def bench_save(directory, count=5000):
+    config_file = os.path.join(directory, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump({'clips': []}, f)
+
+    clip_list = []
+    for i, id in enumerate(synthetic_ids(count)):
+        clip = clips.make_clip(id, i * clips.SECOND, 3 * clips.SECOND, 25.0,
+                               4.5, (320.0, 180.0), "Subtitle " + str(i))
+        clip_list.append(clip)
+
+    # What save_clip does for every clip, besides the writer
+    processed = registry.ClipRegistry()
+    clip_journal = journal.ClipJournal(config_file, compact_every=count + 1)
+    started = time.perf_counter()
+    for clip in clip_list:
+        clip_journal.append(clip)
+        processed.add(clip['id'])
+    clip_journal.sync()
+    append_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    clip_journal.close()
+    compact_time = time.perf_counter() - started
+
+    return {
+        'clips_per_s': count / append_time,
+        'compact_clips_per_s': count / compact_time,
+    }
+
+
+def bench_engine(count=20000):
+    """Picking the clips of every scene, without running the jobs."""
+    scene_index = scenes.SceneIndex(10.0 * i for i in range(1, count // 4))
+    subtitle_index = subtitles.SubtitleIndex(
+        (i * 25 * clips.SECOND // 10, 2 * clips.SECOND, "Subtitle " + str(i))
+        for i in range(count))
+    config = {'image_root': 'images/', 'image_extension': '.jpg'}
+    intervals = list(scene_index.intervals(count * 2.5))
+
+    def pick_all():
+        jobs = []
+        picker = engine.PickerEngine(config, submit=jobs.append)
+        picker.open('Show-s01e01.mkv', 25.0, (1280, 720))
+        picker.set_scenes(scene_index)
+        picker.set_subtitle_index(subtitle_index)
+        for scene in intervals:
+            picker.pick_scene(*scene)
+        return jobs
+
+    clip_count = sum(len(job.clips) for job in pick_all())
+    return {'picked_clips_per_s': clip_count / best_time(pick_all)}
+
+
+def bench_clipstore(directory, count=20000, frames=30, joints=18):
+    """Loading and filtering clips with pose points, as JSON and as a store."""
+    import clipstore
+
+    clip_list = []
+    for i, id in enumerate(synthetic_ids(count)):
+        clip = clips.make_clip(id, i * clips.SECOND,
+                               (i % 5 + 1) * clips.SECOND, 25.0, 4.5,
+                               (320.0, 180.0), "Subtitle " + str(i))
+        clip['points_2d'] = [[[0.25 * j, 0.5 * j] for j in range(joints)]
+                             for _ in range(frames)]
+        clip_list.append(clip)
+    config_file = os.path.join(directory, 'clips.json')
+    with open(config_file, 'w') as f:
+        json.dump({'clips': clip_list}, f)
+    store_path = os.path.join(directory, 'clips.store')
+    clipstore.import_json(config_file, store_path)
+    del clip_list
+
+    def filter_json():
+        with open(config_file) as f:
+            loaded = json.load(f)['clips']
+        return [clip for clip in loaded if clip['end'] - clip['start'] > 50]
+
+    def filter_store():
+        store = clipstore.ClipStore(store_path)
+        return [store.clip_points('points_2d', i)
+                for i in store.select(min_duration=51)]
+
+    return {
+        'json_clips_per_s': count / best_time(filter_json),
+        'store_clips_per_s': count / best_time(filter_store),
+        'store_filter_peak_kb': peak_memory(filter_store),
+    }
+
+
+def make_test_video(path, seconds=20, size='640x360', rate=25):
+    subprocess.run([
+        'ffmpeg', '-nostdin', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'testsrc=size={0}:rate={1}'.format(size, rate),
+        '-t', str(seconds), '-g', str(rate * 2), '-pix_fmt', 'yuv420p',
+        path], check=True)
+
+
+def bench_extraction(directory, clip_count=8, clip_seconds=2.0):
+    video = os.path.join(directory, 'testsrc-bench.mp4')
+    make_test_video(video)
+    config = {'image_root': os.path.join(directory, 'images') + '/',
+              'image_extension': '.jpg'}
+
+    def extract(batched):
+        shutil.rmtree(config['image_root'], ignore_errors=True)
+        queue = extraction.ExtractionQueue(1)
+        batch = extraction.ExtractionBatch(video, clip_count)
+        jobs = []
+        for i in range(clip_count):
+            start = i * clip_seconds
+            clip = clips.make_clip(clips.clip_id(video, i),
+                                   int(start * clips.SECOND),
+                                   int(clip_seconds * clips.SECOND), 25.0,
+                                   4.5, (320.0, 180.0), '')
+            batch.add(clip, clips.extraction_output(config, clip,
+                                                    (640, 360)),
+                      start, clip_seconds)
+            if not batched:
+                jobs.append(queue.submit(batch.job()))
+        if batched:
+            jobs.append(queue.submit(batch.job()))
+        queue.close()
+        frames = sum(sum(job.frames) for job in jobs)
+        if not frames or any(job.error for job in jobs):
+            raise RuntimeError("Extraction failed: " + str(
+                [job.error for job in jobs]))
+        return frames
+
+    results = {}
+    for name, batched in (('single', False), ('batched', True)):
+        started = time.perf_counter()
+        frames = extract(batched)
+        results[name + '_frames_per_s'] = frames / (
+            time.perf_counter() - started)
+    return results
+
+
+def load_baselines():
+    if not os.path.isfile(BASELINES):
+        return {}
+    with open(BASELINES) as f:
+        return json.load(f)
+
+
+def regressions(results, baseline, tolerance):
+    """Metrics that got worse than the baseline by more than tolerance."""
+    failed = []
+    for metric, value in results.items():
+        if metric not in baseline:
+            continue
+        if metric.endswith('_kb'):
+            if value > baseline[metric] * (1 + tolerance):
+                failed.append(metric)
+        elif value < baseline[metric] * (1 - tolerance):
+            failed.append(metric)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='1000,100000',
+                        help="comma separated frame counts of the scene "
+                        "files and sizes of the id sets, up to 1000000")
+    parser.add_argument('--only', help="only run benchmarks whose name "
+                        "starts with this")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed change relative to the baseline")
+    parser.add_argument('--update', action='store_true',
+                        help="store the results as the new baselines")
+    args = parser.parse_args()
+
+    random.seed(0)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    directory = tempfile.mkdtemp()
+    benchmarks = []
+    for size in sizes:
+        benchmarks.append(('scenes.' + str(size),
+                           lambda size=size: bench_scene_index(directory,
+                                                               size)))
+        benchmarks.append(('registry.' + str(size),
+                           lambda size=size: bench_registry(
+                               synthetic_ids(size))))
+    benchmarks.append(('save', lambda: bench_save(directory)))
+    benchmarks.append(('engine', bench_engine))
+    try:
+        import numpy  # noqa: F401
+        benchmarks.append(('clipstore', lambda: bench_clipstore(directory)))
+    except ImportError:
+        print("numpy not found, skipping the clip store benchmark")
+    if shutil.which('ffmpeg'):
+        benchmarks.append(('extraction', lambda: bench_extraction(directory)))
+    else:
+        print("ffmpeg not found, skipping the extraction benchmark")
+
+    baselines = load_baselines()
+    failed = False
+    try:
+        for name, function in benchmarks:
+            if args.only and not name.startswith(args.only):
+                continue
+            results = function()
+            key = 'suite.' + name
+            worse = regressions(results, baselines.get(key, {}),
+                                args.tolerance)
+            print(name)
+            for metric, value in sorted(results.items()):
+                print("  {0:24} {1:14,.0f}{2}".format(
+                    metric, value, "  FAIL" if metric in worse else ""))
+            if args.update:
+                baselines[key] = dict((metric, round(value, 1))
+                                      for metric, value in results.items())
+            elif key not in baselines:
+                print("  no baseline stored yet")
+            failed = failed or bool(worse)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.update:
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Stored new baselines")
+    elif failed:
+        print("FAIL: slower or larger than the baselines")
+
+    sys.exit(1 if failed and not args.update else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Frame capture from the playback pipeline, as an alternative to ffmpeg
+
+The picker feeds decoded frames from an appsink branch into a FrameCapture,
+which writes the frames of every clip being recorded on a pool of encoder
+threads. That saves decoding the video a second time, and the saved frames
+are exactly the ones that were shown.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+Frame = collections.namedtuple('Frame', ['pts', 'width', 'height', 'stride',
+                                         'data'])
+
+
+def _png_chunk(kind, body):
+    return (struct.pack('>I', len(body)) + kind + body +
+            struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff))
+
+
+def encode_png(frame, level=1):
+    """PNG file contents for an RGB frame."""
+    row_size = frame.width * 3
+    data = memoryview(frame.data)
+    # Every row starts with its filter type, 0 for none
+    raw = b''.join(b'\x00' + data[offset:offset + row_size]
+                   for offset in range(0, frame.height * frame.stride,
+                                       frame.stride))
+    header = struct.pack('>IIBBBBB', frame.width, frame.height, 8, 2, 0, 0, 0)
+    return (PNG_SIGNATURE + _png_chunk(b'IHDR', header) +
+            _png_chunk(b'IDAT', zlib.compress(raw, level)) +
+            _png_chunk(b'IEND', b''))
+
+
+def write_frame(frame, path):
+    if path.lower().endswith('.png'):
+        with open(path, 'wb') as f:
+            f.write(encode_png(frame))
+    else:
+        # Pillow is only needed for formats other than PNG
+        from PIL import Image
+        image = Image.frombuffer('RGB', (frame.width, frame.height),
+                                 frame.data, 'raw', 'RGB', frame.stride, 1)
+        image.save(path, quality=95)
+
+
+class CaptureWindow:
+    """Frames of one clip, captured between start and end (nanoseconds).
+
+    Has the same interface as extraction.ExtractionJob, so both are saved
+    the same way.
+    """
+
+    def __init__(self, clip, output_pattern, start, end, callback=None):
+        self.clips = [clip]
+        self.output_patterns = [output_pattern]
+        self.start = start
+        self.end = end
+        self.callback = callback
+
+        self.frames = [0]
+        self.error = None
+        self.closed = False
+        self.writing = 0
+        self.done = threading.Event()
+
+    @property
+    def ok(self):
+        return self.done.is_set() and self.error is None
+
+    def extracted(self):
+        if self.error is not None:
+            return []
+        return [(self.clips[0], self.frames[0])]
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class FrameCapture:
+    """Writes the frames of the clips being recorded.
+
+    push() is called with every decoded frame, from the streaming thread.
+    Since that branch runs ahead of playback, the last history frames are
+    kept so clips added a little late still get their first frames. At most
+    max_pending frames wait to be written; push() blocks when encoding
+    falls behind, which holds back the capture branch.
+    """
+
+    def __init__(self, workers=None, history=16, max_pending=None):
+        workers = workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.max_pending = max_pending or 2 * workers
+        self.history = collections.deque(maxlen=history)
+        self.windows = []
+        self.pending = 0
+        # Reentrant: write callbacks run right away for finished writes
+        self.lock = threading.RLock()
+        self.idle = threading.Condition(self.lock)
+
+    def add(self, clip, output_pattern, start, end, callback=None):
+        window = CaptureWindow(clip, output_pattern, start, end, callback)
+        os.makedirs(os.path.dirname(output_pattern), exist_ok=True)
+        with self.lock:
+            for frame in self.history:
+                self._add_frame(window, frame)
+            if not window.closed:
+                self.windows.append(window)
+        return window
+
+    def push(self, frame):
+        with self.idle:
+            # Releases the lock while waiting, so writes can finish
+            self.idle.wait_for(lambda: self.pending < self.max_pending)
+            if self.history and frame.pts < self.history[-1].pts:
+                self.history.clear()  # Seeked back
+            self.history.append(frame)
+
+            for window in self.windows:
+                self._add_frame(window, frame)
+            self.windows = [w for w in self.windows if not w.closed]
+            self.idle.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until every clip got its frames and they're written.
+
+        Returns False if that didn't happen within timeout seconds.
+        """
+        with self.idle:
+            return self.idle.wait_for(
+                lambda: not self.windows and self.pending == 0, timeout)
+
+    def flush(self, complete=False):
+        """Close all open windows.
+
+        Unless complete is set (at the end of the video), clips that
+        didn't get all their frames yet are failed.
+        """
+        with self.lock:
+            for window in self.windows:
+                if not complete:
+                    window.error = "Capture stopped before the clip ended"
+                self._close(window)
+            self.windows = []
+            self.history.clear()
+            self.idle.notify_all()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def _add_frame(self, window, frame):
+        if frame.pts >= window.end:
+            self._close(window)
+        elif frame.pts >= window.start:
+            window.frames[0] += 1
+            window.writing += 1
+            self.pending += 1
+            path = window.output_patterns[0] % window.frames[0]
+            future = self.executor.submit(write_frame, frame, path)
+            future.add_done_callback(
+                lambda future: self._on_written(window, future))
+
+    def _on_written(self, window, future):
+        error = future.exception()
+        with self.lock:
+            if error is not None and window.error is None:
+                window.error = "Could not write frame: " + str(error)
+            window.writing -= 1
+            self.pending -= 1
+            finished = window.closed and window.writing == 0
+            self.idle.notify_all()
+        if finished:
+            self._finish(window)
+
+    def _close(self, window):
+        # Called with the lock held
+        if window.closed:
+            return
+        window.closed = True
+        if window.frames[0] == 0 and window.error is None:
+            window.error = "No frames captured"
+        if window.writing == 0:
+            # Nothing being written anymore, finish outside the lock
+            self.executor.submit(self._finish, window)
+
+    def _finish(self, window):
+        window.done.set()
+        if window.error is None:
+            logger.info("Captured %d frames for %s", window.frames[0],
+                        window.output_patterns[0])
+        else:
+            logger.error("Capture failed for %s: %s",
+                         window.output_patterns[0], window.error)
+        if window.callback is not None:
+            try:
+                window.callback(window)
+            except Exception:
+                logger.exception("Capture callback failed")
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+Clip rules shared by the picker UI and the headless extractor
+"""
+
+import collections
+import logging
+import math
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Subtitle timestamps are GStreamer clock times, in nanoseconds
+SECOND = 1000000000
+
+# Clips of this many frames or less are not worth saving
+MIN_CLIP_FRAMES = 15
+
+# An ffmpeg output for the frames of one clip. frame_bytes is the size of a
+# frame when they are packed in a single file, None for image sequences.
+# framerate is the video's when only some frames are kept, to map them back
+# to video frame numbers, else None.
+ExtractionOutput = collections.namedtuple('ExtractionOutput', [
+    'path', 'video_filter', 'options', 'frame_bytes', 'framerate'])
+
+# showinfo log line of a kept frame of output i, see sampling_filter
+SHOWINFO = re.compile(
+    r'\[showinfo@o(\d+) @ [^\]]*\] n:\s*\d+ pts:\s*-?\d+ '
+    r'pts_time:(-?[\d.]+)')
+
+
+def clip_id(filename, subtitle_start):
+    filename = os.path.basename(filename)
+    return filename.split('.')[-2].split('-')[-1] + str(subtitle_start)
+
+
+def clip_alignment(subtitle_start, subtitle_duration, scene_start,
+                   next_scene_start):
+    """Position of a subtitle relative to a scene.
+
+    Returns 1 when the subtitle ends after the scene, -1 when it starts
+    before the scene and 0 when it lies completely within it.
+    """
+    subtitle_end = float(subtitle_start + subtitle_duration) / SECOND
+    subtitle_start = float(subtitle_start) / SECOND
+
+    if subtitle_end >= next_scene_start:
+        return 1
+    elif subtitle_start < scene_start:
+        return -1
+    else:
+        return 0
+
+
+def make_clip(id, subtitle_start, subtitle_duration, framerate, scale,
+              center, subtitle):
+    """Build the clip record, or return None if the clip is too short."""
+    start = math.floor(float(subtitle_start) * framerate / SECOND)
+    duration = math.ceil(float(subtitle_duration) * framerate / SECOND)
+    if duration <= MIN_CLIP_FRAMES:
+        return None
+
+    return {
+        'id': id,
+        'start': start,
+        'end': start + duration,
+        'scale': scale,
+        'center': list(center),
+        'points_2d': [],
+        'points_3d': [],
+        'subtitle': subtitle
+    }
+
+
+def image_pattern(config, id):
+    return os.path.join(
+        os.getcwd(),
+        config['image_root'] + id + '-%06d' + config['image_extension']
+    )
+
+
+def pack_path(config, filename):
+    """Packed frame store for the clips of a video, see packstore."""
+    return config['image_root'] + clip_id(filename, '') + '.pack'
+
+
+def crop_box(center, scale, frame_size):
+    """Detection square (x, y, edge) around center, moved inside the frame.
+
+    Values are even, so cropping doesn't shift subsampled chroma planes.
+    """
+    width, height = frame_size
+    edge = min(int(round(scale * 128)), width, height) // 2 * 2
+
+    def place(position, limit):
+        return int(min(max(position - edge / 2.0, 0), limit - edge)) // 2 * 2
+
+    return place(center[0], width), place(center[1], height), edge
+
+
+def sampling_filter(config):
+    """Filter keeping only some frames of a clip, or None for all.
+
+    config['sample_fps'] keeps at most that many frames per second, and
+    config['dedupe_threshold'] drops frames that differ from the last kept
+    one by no more than that on average (0-255) in every 8x8 block. Both
+    keep the timestamps of the frames.
+    """
+    filters = []
+    fps = config.get('sample_fps')
+    if fps:
+        # A little less than the interval, for rounded timestamps
+        filters.append(
+            "select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,"
+            "{0})'".format(1.0 / fps - 1e-3))
+    threshold = config.get('dedupe_threshold')
+    if threshold:
+        filters.append('mpdecimate=hi={0}:lo={0}:frac=0'.format(
+            int(64 * threshold)))
+    return ','.join(filters) or None
+
+
+def extraction_output(config, clip, frame_size, framerate=None):
+    """Where and how the frames of a clip are written.
+
+    By default, every frame is a separate image in config['image_root'].
+    With config['crop_to_detection'], only the detection square is kept,
+    resized to config['crop_size'] when set. With config['packed_frames'],
+    the frames are written as one uncompressed RGB file per clip. Both add
+    their parameters to the clip record.
+
+    With a sampling_filter and the video's framerate, only some frames are
+    written, and the clip gets a 'frame_map' with the video frame number of
+    every one once they're extracted.
+
+    Cropping and packing need the frame size; while it is None (before the
+    video caps are known), frames are written as full images instead.
+    """
+    video_filter = None
+    output_size = frame_size
+    if frame_size is None and (config.get('crop_to_detection', False) or
+                               config.get('packed_frames', False)):
+        logger.warning("Frame size of clip %s unknown, writing full images",
+                       clip['id'])
+    if config.get('crop_to_detection', False) and frame_size is not None:
+        x, y, edge = crop_box(clip['center'], clip['scale'], frame_size)
+        output_edge = config.get('crop_size') or edge
+        video_filter = 'crop={0}:{0}:{1}:{2}'.format(edge, x, y)
+        if output_edge != edge:
+            video_filter += ',scale={0}:{0}'.format(output_edge)
+        output_size = (output_edge, output_edge)
+        clip['crop'] = {'x': x, 'y': y, 'size': edge,
+                        'output_size': output_edge}
+
+    # Sampled after cropping, so only changes in the kept square count
+    options = []
+    sampling = sampling_filter(config)
+    if sampling is None:
+        framerate = None
+    elif framerate is not None:
+        video_filter = ','.join(f for f in (video_filter, sampling) if f)
+        # Don't duplicate frames to fill the gaps
+        options = ['-vsync', 'vfr']
+        clip['frame_map'] = []
+
+    if not config.get('packed_frames', False) or output_size is None:
+        return ExtractionOutput(image_pattern(config, clip['id']),
+                                video_filter, options, None, framerate)
+
+    path = os.path.join(os.getcwd(),
+                        config['image_root'] + clip['id'] + '.rgb')
+    width, height = output_size
+    clip['frames'] = {
+        'path': config['image_root'] + clip['id'] + '.rgb',
+        'format': 'rgb24',
+        'width': width,
+        'height': height,
+        'count': 0
+    }
+    return ExtractionOutput(path, video_filter,
+                            options + ['-f', 'rawvideo', '-pix_fmt', 'rgb24'],
+                            width * height * 3, framerate)
+
+
+def output_filter(output, i):
+    """Filter of output i of a command, logging its frames when sampled."""
+    if output.framerate is None:
+        return output.video_filter
+    return output.video_filter + ',showinfo@o' + str(i)
+
+
+def frame_maps(log, outputs, start):
+    """Video frame numbers of the frames written for every sampled output.
+
+    log is ffmpeg's info level output and start the time in the video that
+    its timestamps are relative to.
+    """
+    maps = [[] for _ in outputs]
+    for match in SHOWINFO.finditer(log):
+        i = int(match.group(1))
+        framerate = outputs[i].framerate
+        maps[i].append(int(round((start + float(match.group(2)))
+                                 * framerate)))
+    return maps
+
+
+def log_level(outputs):
+    # showinfo logs at the info level
+    if any(output.framerate is not None for output in outputs):
+        return ['-loglevel', 'info', '-hide_banner', '-nostats']
+    return ['-loglevel', 'error']
+
+
+def extraction_command(filename, output, start, duration):
+    """ffmpeg command writing the frames in [start, start + duration]."""
+    command = [
+        'ffmpeg',
+        '-nostdin',
+        '-y'
+    ] + log_level([output]) + [
+        '-ss', str(start),
+        '-t', str(duration),
+        '-i', filename
+    ]
+    video_filter = output_filter(output, 0)
+    if video_filter:
+        command += ['-vf', video_filter]
+    return command + output.options + [output.path]
+
+
+def batch_extraction_command(filename, segments):
+    """ffmpeg command writing several clips while decoding the source once.
+
+    segments is a list of (output, start, duration). The input is decoded
+    from the earliest start to the latest end and split into one trimmed
+    branch per clip.
+    """
+    if len(segments) == 1:
+        return extraction_command(filename, *segments[0])
+
+    batch_start = min(start for _, start, _ in segments)
+    batch_end = max(start + duration for _, start, duration in segments)
+
+    filters = ['[0:v]split=' + str(len(segments))
+               + ''.join('[s' + str(i) + ']' for i in range(len(segments)))]
+    outputs = []
+    for i, (output, start, duration) in enumerate(segments):
+        # Input timestamps start at zero after seeking to batch_start
+        chain = 'trim=start={0}:duration={1}'.format(start - batch_start,
+                                                      duration)
+        # Before resetting the timestamps, so sampled frames are logged at
+        # their time in the batch
+        video_filter = output_filter(output, i)
+        if video_filter:
+            chain += ',' + video_filter
+        chain += ',setpts=PTS-STARTPTS'
+        filters.append('[s{0}]{1}[o{0}]'.format(i, chain))
+        outputs += ['-map', '[o' + str(i) + ']'] + output.options + [
+            output.path]
+
+    return [
+        'ffmpeg',
+        '-nostdin',
+        '-y'
+    ] + log_level([output for output, _, _ in segments]) + [
+        '-ss', str(batch_start),
+        '-t', str(batch_end - batch_start),
+        '-i', filename,
+        '-filter_complex', ';'.join(filters)
+    ] + outputs
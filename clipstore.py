@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+"""
+Columnar store of clip records, for loading and filtering large datasets
+
+The clips of config.json are stored in a directory with one file per
+column: ids, frame ranges, scales and centers as typed numpy arrays, and
+the subtitles and pose points as one contiguous array per field with the
+offsets of every clip. Every file is memory mapped when loaded, so opening
+a store with millions of points reads nothing until it's used, and filters
+on the scalar columns run on whole arrays at once.
+
+Points that are regular arrays are stored with their shape. Ragged ones,
+like a different number of joints in some frames, are stored with the
+length of every nested list, level by level.
+
+Keys besides the standard clip fields (like 'crop' and 'frames') are kept
+as JSON, so exporting a store gives back the clips it was made from.
+Points are stored as float32 when every value of a field is exactly a
+float32, and as float64 otherwise. Pass --point-dtype float32 to always
+store float32, rounding the values that aren't.
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy
+
+import clips
+
+# Fields of clips.make_clip, in order
+FIELDS = ('id', 'start', 'end', 'scale', 'center', 'points_2d', 'points_3d',
+          'subtitle')
+POINT_FIELDS = ('points_2d', 'points_3d')
+
+# Dimensions of the points of one clip, like (frames, joints, coordinates)
+MAX_POINT_DIMS = 4
+
+VERSION = 2
+
+
+def _write_text(directory, name, texts):
+    """Store strings as one UTF-8 blob with the offsets of every string."""
+    data = [text.encode('UTF-8') for text in texts]
+    offsets = numpy.zeros(len(data) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(item) for item in data], out=offsets[1:])
+    with open(os.path.join(directory, name + '.bin'), 'wb') as f:
+        for item in data:
+            f.write(item)
+    numpy.save(os.path.join(directory, name + '_offsets.npy'), offsets)
+
+
+def _ragged_rows(points):
+    """Nesting depth and list lengths of ragged points, and their values.
+
+    The lengths are listed level by level, starting with the one list of
+    the top level, so every level has as many lengths as the sum of the
+    lengths of the level before it.
+    """
+    depth = 0
+    rows = []
+    level = [points]
+    while True:
+        depth += 1
+        rows.extend(len(item) for item in level)
+        children = [child for item in level for child in item]
+        nested = [isinstance(child, (list, tuple)) for child in children]
+        if not any(nested):
+            return [depth] + rows, children
+        if not all(nested):
+            raise ValueError("mix numbers and lists at the same level")
+        level = children
+
+
+def _unflatten(values, rows):
+    """Nested lists of arrays from values and the rows of _ragged_rows."""
+    depth = int(rows[0])
+    levels = []
+    count = 1
+    position = 1
+    for _ in range(depth):
+        lengths = rows[position:position + count]
+        levels.append(lengths)
+        position += count
+        count = int(lengths.sum())
+
+    # Split the values by the innermost lengths, then group the parts
+    ends = numpy.cumsum(levels[-1])
+    items = [values[end - length:end]
+             for end, length in zip(ends.tolist(), levels[-1].tolist())]
+    for lengths in reversed(levels[:-1]):
+        grouped = []
+        start = 0
+        for length in lengths.tolist():
+            grouped.append(items[start:start + length])
+            start += length
+        items = grouped
+    return items[0]
+
+
+def _to_list(points):
+    if isinstance(points, list):
+        return [_to_list(item) for item in points]
+    return points.tolist()
+
+
+def _point_dtype(values):
+    """float32 if every value is exactly a float32, float64 otherwise."""
+    narrow = values.astype(numpy.float32)
+    exact = (narrow == values) | (numpy.isnan(narrow) & numpy.isnan(values))
+    return numpy.float32 if exact.all() else numpy.float64
+
+
+def _write_points(directory, name, clip_list, dtype=None):
+    """Store the points of every clip flattened into one array.
+
+    dtype None picks float32 or float64 with _point_dtype.
+    """
+    shapes = numpy.full((len(clip_list), MAX_POINT_DIMS), -1,
+                        dtype=numpy.int64)
+    offsets = numpy.zeros(len(clip_list) + 1, dtype=numpy.int64)
+    # Lengths of the nested lists of ragged clips, empty for regular ones
+    rows = []
+    row_offsets = numpy.zeros(len(clip_list) + 1, dtype=numpy.int64)
+    path = os.path.join(directory, name + '.npy')
+    values = []
+    for i, clip in enumerate(clip_list):
+        try:
+            points = numpy.asarray(clip[name], dtype=numpy.float64)
+        except ValueError:
+            try:
+                clip_rows, children = _ragged_rows(clip[name])
+                points = numpy.asarray(children, dtype=numpy.float64)
+            except (TypeError, ValueError) as e:
+                raise ValueError("The {0} of clip {1} {2}".format(
+                    name, clip['id'], e))
+            rows.extend(clip_rows)
+        else:
+            if points.ndim > MAX_POINT_DIMS:
+                raise ValueError("The {0} of clip {1} have more than {2} "
+                                 "dimensions".format(name, clip['id'],
+                                                     MAX_POINT_DIMS))
+            shapes[i, :points.ndim] = points.shape
+        offsets[i + 1] = offsets[i] + points.size
+        row_offsets[i + 1] = len(rows)
+        values.append(points.ravel())
+
+    flat = (numpy.concatenate(values) if values
+            else numpy.zeros(0, numpy.float64))
+    if dtype is None:
+        dtype = _point_dtype(flat)
+    numpy.save(path, flat.astype(dtype))
+    numpy.save(os.path.join(directory, name + '_offsets.npy'), offsets)
+    numpy.save(os.path.join(directory, name + '_shape.npy'), shapes)
+    numpy.save(os.path.join(directory, name + '_rows.npy'),
+               numpy.array(rows, dtype=numpy.int64))
+    numpy.save(os.path.join(directory, name + '_row_offsets.npy'),
+               row_offsets)
+    return numpy.dtype(dtype).name
+
+
+def write_store(path, clip_list, point_dtype=None):
+    """Write clip records as a store in directory path, replacing it.
+
+    Points are stored as point_dtype, or without losing precision when it
+    is None.
+    """
+    for clip in clip_list:
+        missing = [field for field in FIELDS if field not in clip]
+        if missing:
+            raise ValueError("Clip {0} has no {1}".format(
+                clip.get('id'), ', '.join(missing)))
+
+    temporary = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    ids = [clip['id'].encode('UTF-8') for clip in clip_list]
+    numpy.save(os.path.join(temporary, 'id.npy'),
+               numpy.array(ids, dtype='S' + str(max([1] + [
+                   len(id) for id in ids]))))
+    numpy.save(os.path.join(temporary, 'start.npy'),
+               numpy.array([clip['start'] for clip in clip_list],
+                           dtype=numpy.int64))
+    numpy.save(os.path.join(temporary, 'end.npy'),
+               numpy.array([clip['end'] for clip in clip_list],
+                           dtype=numpy.int64))
+    numpy.save(os.path.join(temporary, 'scale.npy'),
+               numpy.array([clip['scale'] for clip in clip_list],
+                           dtype=numpy.float64))
+    numpy.save(os.path.join(temporary, 'center.npy'),
+               numpy.array([clip['center'] for clip in clip_list],
+                           dtype=numpy.float64).reshape(-1, 2))
+    point_dtypes = dict(
+        (name, _write_points(temporary, name, clip_list, point_dtype))
+        for name in POINT_FIELDS)
+    _write_text(temporary, 'subtitle',
+                [clip['subtitle'] for clip in clip_list])
+
+    # Everything else, in its original order
+    _write_text(temporary, 'extra', [
+        json.dumps([[key, value] for key, value in clip.items()
+                    if key not in FIELDS]) for clip in clip_list])
+
+    with open(os.path.join(temporary, 'store.json'), 'w') as f:
+        json.dump({'version': VERSION, 'count': len(clip_list),
+                   'point_dtypes': point_dtypes}, f)
+
+    # Swap the new store in, then delete the old one
+    old = path.rstrip(os.sep) + '.old'
+    if os.path.isdir(path):
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(path, old)
+    os.rename(temporary, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+class ClipStore:
+    """Clips of a store directory, with its columns as mapped arrays.
+
+    ids, start, end, scale and center have one entry per clip. Clips are
+    addressed by their position, as returned by select().
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, 'store.json')) as f:
+            info = json.load(f)
+        if info['version'] != VERSION:
+            raise ValueError("Unsupported clip store version " +
+                             str(info['version']))
+        self.count = info['count']
+        self.mmap_mode = 'r' if mmap else None
+
+        self.ids = self._load('id')
+        self.start = self._load('start')
+        self.end = self._load('end')
+        self.scale = self._load('scale')
+        self.center = self._load('center')
+        self.points = dict(
+            (name, (self._load(name), self._load(name + '_offsets'),
+                    self._load(name + '_shape'), self._load(name + '_rows'),
+                    self._load(name + '_row_offsets')))
+            for name in POINT_FIELDS)
+        self.subtitles = self._load_text('subtitle')
+        self.extras = self._load_text('extra')
+
+    def _load(self, name):
+        return numpy.load(os.path.join(self.path, name + '.npy'),
+                          mmap_mode=self.mmap_mode)
+
+    def _load_text(self, name):
+        path = os.path.join(self.path, name + '.bin')
+        if os.path.getsize(path) == 0:
+            data = numpy.zeros(0, dtype=numpy.uint8)  # Can't map empty files
+        elif self.mmap_mode:
+            data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        else:
+            data = numpy.fromfile(path, dtype=numpy.uint8)
+        return data, self._load(name + '_offsets')
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def duration(self):
+        """Length of every clip, in frames."""
+        return self.end - self.start
+
+    def select(self, min_duration=None, max_duration=None, min_scale=None,
+               max_scale=None, video=None):
+        """Positions of the clips matching every given bound.
+
+        video is a video filename; its clips are the ones whose id starts
+        with clips.clip_id(video, ''), like for clips.pack_path.
+        """
+        mask = numpy.ones(self.count, dtype=bool)
+        duration = self.duration
+        if min_duration is not None:
+            mask &= duration >= min_duration
+        if max_duration is not None:
+            mask &= duration <= max_duration
+        if min_scale is not None:
+            mask &= self.scale >= min_scale
+        if max_scale is not None:
+            mask &= self.scale <= max_scale
+        if video is not None:
+            prefix = clips.clip_id(video, '').encode('UTF-8')
+            mask &= numpy.char.startswith(self.ids, prefix)
+        return numpy.flatnonzero(mask)
+
+    def clip_points(self, name, i):
+        """Points of clip i as an array, a view of the store.
+
+        Ragged points are nested lists of one dimensional arrays instead.
+        """
+        values, offsets, shapes, rows, row_offsets = self.points[name]
+        values = values[offsets[i]:offsets[i + 1]]
+        if len(rows) and row_offsets[i] < row_offsets[i + 1]:
+            return _unflatten(values, rows[row_offsets[i]:row_offsets[i + 1]])
+        shape = tuple(int(size) for size in shapes[i] if size >= 0)
+        return values.reshape(shape)
+
+    def text(self, column, i):
+        data, offsets = column
+        return bytes(data[offsets[i]:offsets[i + 1]]).decode('UTF-8')
+
+    def clip(self, i):
+        """The clip record at position i, like in config.json."""
+        clip = {
+            'id': self.ids[i].decode('UTF-8'),
+            'start': int(self.start[i]),
+            'end': int(self.end[i]),
+            'scale': float(self.scale[i]),
+            'center': self.center[i].tolist(),
+            'points_2d': _to_list(self.clip_points('points_2d', i)),
+            'points_3d': _to_list(self.clip_points('points_3d', i)),
+            'subtitle': self.text(self.subtitles, i)
+        }
+        for key, value in json.loads(self.text(self.extras, i)):
+            clip[key] = value
+        return clip
+
+    def clips(self, positions=None):
+        if positions is None:
+            positions = range(self.count)
+        return [self.clip(i) for i in positions]
+
+
+def import_json(config_file, path, point_dtype=None):
+    """Make a store of the clips of a config file."""
+    with open(config_file, encoding='UTF-8') as f:
+        config = json.load(f)
+    write_store(path, config.get('clips', []), point_dtype)
+    return len(config.get('clips', []))
+
+
+def export_json(path, config_file, positions=None):
+    """Write the clips of a store into the 'clips' of a config file."""
+    config = {}
+    if os.path.isfile(config_file):
+        with open(config_file, encoding='UTF-8') as f:
+            config = json.load(f)
+    config['clips'] = ClipStore(path).clips(positions)
+
+    temporary = config_file + '.tmp'
+    with open(temporary, 'w', encoding='UTF-8') as f:
+        json.dump(config, f, indent=2)
+    os.replace(temporary, config_file)
+    return len(config['clips'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert clips between config.json and a clip store")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    to_store = subparsers.add_parser('import', help="config file to store")
+    to_store.add_argument('config_file')
+    to_store.add_argument('store')
+    to_store.add_argument('--point-dtype', choices=('float32', 'float64'),
+                          help="(default: float32 if it is exact, "
+                          "float64 otherwise)")
+
+    to_json = subparsers.add_parser(
+        'export', help="store to the clips of a config file")
+    to_json.add_argument('store')
+    to_json.add_argument('config_file')
+
+    select = subparsers.add_parser('select',
+                                   help="print the ids of matching clips")
+    select.add_argument('store')
+
+    for command in (to_json, select):
+        command.add_argument('--min-duration', type=int)
+        command.add_argument('--max-duration', type=int)
+        command.add_argument('--min-scale', type=float)
+        command.add_argument('--max-scale', type=float)
+        command.add_argument('--video')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        count = import_json(args.config_file, args.store, args.point_dtype)
+        print("Stored {0} clips in {1}".format(count, args.store))
+        return
+
+    store = ClipStore(args.store)
+    positions = store.select(args.min_duration, args.max_duration,
+                             args.min_scale, args.max_scale, args.video)
+    if args.command == 'export':
+        count = export_json(args.store, args.config_file, positions)
+        print("Exported {0} clips to {1}".format(count, args.config_file))
+    else:
+        for i in positions:
+            print(store.ids[i].decode('UTF-8'))
+
+
+if __name__ == '__main__':
+    main()
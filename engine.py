@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+"""
+Clip picking core of video-picker, without GTK or GStreamer
+
+The engine holds the state of one video (scenes, subtitles, the detection
+square and record mode) and applies the clip rules to it. Frontends feed it
+plain data, like playback positions and subtitles, and it turns picked
+subtitles into clip records and extraction jobs. The picker window, the
+headless extractor and the batch extractor all drive one.
+"""
+
+import logging
+
+import clips
+import extraction
+import packstore
+import registry
+import scenes
+import subtitles
+
+logger = logging.getLogger(__name__)
+
+
+class PickerEngine:
+    """Picks the clips of one video at a time.
+
+    Extraction jobs are passed to submit() and call on_extracted(job) from
+    their worker thread when they're done; the frontend then hands them to
+    finish_job() to get the clips to save. on_change() is called whenever
+    something a frontend shows changed. With a capture.FrameCapture,
+    subtitles picked while recording are written from the played frames
+    instead of extracted with ffmpeg. With a jobqueue.JobAdder, clips are
+    added to its queue instead, batched like extraction jobs, for its
+    workers to extract. The frontend passes what the adder reports to
+    jobs_added() and collects the finished clips from the queue.
+    """
+
+    def __init__(self, config, processed_ids=None, submit=None,
+                 on_extracted=None, on_change=None, capture=None, jobs=None):
+        self.config = config
+        if processed_ids is None:
+            processed_ids = registry.ClipRegistry()
+        self.processed_ids = processed_ids
+        self.submit = submit
+        self.on_extracted = on_extracted
+        self.on_change = on_change
+        self.capture = capture
+        self.jobs = jobs
+
+        self.filename = ''
+        self.framerate = 1.0
+        self.frame_size = None
+        self.scenes = scenes.SceneIndex()
+        # Subtitles of the whole video, None until they are loaded
+        self.subtitle_index = None
+
+        self.subtitle = ""
+        self.subtitle_start = 0
+        self.subtitle_duration = 0
+        self.split_sub_lines = False
+
+        self.detection_scale = 4.5
+        self.center = (0, 0)
+
+        self.scene_start = 0
+        self.next_scene_start = 0
+        self.recording = False
+
+        # Ids of the clips being extracted
+        self.processing = set()
+        # (id, video, payload) of the clips to add to the job queue
+        self.job_batch = []
+        # (start, duration, text) of the subtitles picked before the
+        # processed ids were loaded, see pick_deferred()
+        self.deferred = []
+        self.batch = extraction.ExtractionBatch(
+            self.filename, config.get('extraction_batch_size', 16))
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def open(self, filename, framerate=None, frame_size=None):
+        """Start on another video, extracting what is left of the last."""
+        self.extract_batch()
+        if self.deferred:
+            logger.warning("Dropping %d picks of %s made before the "
+                           "processed clips were loaded",
+                           len(self.deferred), self.filename)
+            self.deferred = []
+        self.filename = filename
+        if framerate is not None:
+            self.framerate = framerate
+        self.frame_size = frame_size
+        self.batch.filename = filename
+        self.batch.store = None
+        if self.config.get('pack_store', False):
+            self.batch.store = packstore.PackedFrameStore(
+                clips.pack_path(self.config, filename))
+
+        self.scenes = scenes.SceneIndex()
+        self.subtitle_index = None
+        self.changed()
+
+    def set_scenes(self, index):
+        self.scenes = index
+        self.changed()
+
+    def set_subtitle_index(self, index):
+        self.subtitle_index = index
+
+    def clip_id(self, subtitle_start=None):
+        if subtitle_start is None:
+            subtitle_start = self.subtitle_start
+        return clips.clip_id(self.filename, subtitle_start)
+
+    def is_processed(self, id, wait=False):
+        if id in self.processing:
+            return True
+
+        if wait:
+            self.processed_ids.wait()
+        return id in self.processed_ids
+
+    def scene_at(self, current_time):
+        """(current, next, previous) scene start times, see SceneIndex."""
+        return self.scenes.lookup(float(current_time))
+
+    def alignment(self, current_time, update=False):
+        """Alignment of the current subtitle with the scene at current_time.
+
+        Outside the scenes, the last scene bounds are used. With update,
+        the scene bounds are remembered for record mode.
+        """
+        scene_start = self.scene_start
+        next_scene_start = self.next_scene_start
+        current_scene, next_scene, _ = self.scene_at(current_time)
+        if current_scene is not None:
+            scene_start = current_scene
+            next_scene_start = next_scene
+            if update:
+                self.scene_start = scene_start
+                self.next_scene_start = next_scene_start
+
+        return clips.clip_alignment(self.subtitle_start,
+                                    self.subtitle_duration, scene_start,
+                                    next_scene_start)
+
+    def set_subtitle(self, subtitle, start, duration, current_time=None):
+        """Make a subtitle the current one, picking it while recording.
+
+        current_time is the playback position, only needed while recording.
+        Returns the alignment of the subtitle while recording, else None.
+        """
+        self.subtitle = subtitles.format_subtitle(subtitle,
+                                                  self.split_sub_lines)
+        self.subtitle_start = start
+        self.subtitle_duration = duration
+        self.changed()
+
+        if not self.recording:
+            return None
+
+        alignment = self.alignment(current_time, update=True)
+        if alignment == 1:
+            logger.debug("Clip subtitles end after current scene")
+            self.stop_recording()
+        elif alignment == -1:
+            logger.debug("Clip subtitles start before current scene")
+        else:
+            logger.debug("Saving current clip")
+            self.pick()
+        return alignment
+
+    def record_scene(self, current_time, duration=None):
+        """Pick the subtitles of the scene at current_time.
+
+        With the subtitle index, they are all picked right away, unless
+        frames are captured from playback. Otherwise record mode starts and
+        they are picked as they are played; returns the time to seek to for
+        that, or None to record from here.
+        duration is the length of the video, for the last scene.
+        """
+        current_scene, next_scene, _ = self.scene_at(current_time)
+        seek = None
+        if current_scene is not None:
+            self.scene_start = current_scene
+            self.next_scene_start = next_scene
+            seek = current_scene
+        else:
+            # Start recording at the current point
+            self.scene_start = current_time
+            if next_scene is not None:
+                self.next_scene_start = next_scene
+            elif duration is not None:
+                self.next_scene_start = duration
+            else:
+                raise ValueError("The video duration is needed after the "
+                                 "last scene")
+        logger.debug("Scene from %s to %s, position %s", self.scene_start,
+                     self.next_scene_start, current_time)
+
+        captured = self.capture is not None and self.jobs is None
+        if self.subtitle_index is not None and not captured:
+            # All subtitles are known, no need to play the scene. Captured
+            # frames need it played, which saves the second decode instead
+            self.pick_scene(self.scene_start, self.next_scene_start)
+            return None
+
+        # Skip until the first subtitle completely within the scene starts
+        self.recording = True
+        self.changed()
+        return seek
+
+    def stop_recording(self):
+        self.recording = False
+        self.extract_batch()
+        self.changed()
+
+    def new_clip(self, subtitle):
+        """Clip record for a (start, duration, text) subtitle.
+
+        Returns None when the clip is already processed or too short.
+        """
+        subtitle_start, subtitle_duration, text = subtitle
+        id = self.clip_id(subtitle_start)
+        if self.is_processed(id, wait=True):
+            logger.debug("Clip %s is already processed. Not saving.", id)
+            return None
+
+        clip = clips.make_clip(id, subtitle_start, subtitle_duration,
+                               self.framerate, self.detection_scale,
+                               self.center, text)
+        if clip is None:
+            # Shorter than MIN_CLIP_FRAMES
+            logger.debug("Clip %s is too short. Skipping.", id)
+        return clip
+
+    def scene_clips(self, scene_start, next_scene_start):
+        """Clips pick_scene would save for a scene, without saving them."""
+        scene_clips = []
+        for start, duration, text in self.subtitle_index.within(
+                scene_start, next_scene_start):
+            clip = self.new_clip((start, duration, subtitles.format_subtitle(
+                text, self.split_sub_lines)))
+            if clip is not None:
+                scene_clips.append(clip)
+        return scene_clips
+
+    def pick_scene(self, scene_start, next_scene_start):
+        """Pick every indexed subtitle within a scene, in one batch."""
+        scene_subtitles = self.subtitle_index.within(scene_start,
+                                                     next_scene_start)
+        logger.debug("Picking %d subtitles of the scene at %.2fs",
+                     len(scene_subtitles), scene_start)
+        picked = [self.pick(subtitle, batched=True)
+                  for subtitle in scene_subtitles]
+        self.extract_batch()
+        return [clip for clip in picked if clip is not None]
+
+    def pick(self, subtitle=None, batched=None):
+        """Save the clip of the current subtitle.
+
+        subtitle is a (start, duration, text) tuple to save another one.
+        Batched clips are extracted together once the batch is full or
+        extract_batch is called, by default while recording. Returns the
+        clip record, or None when it isn't saved.
+        """
+        if subtitle is None:
+            subtitle = (self.subtitle_start, self.subtitle_duration,
+                        self.subtitle)
+            realtime = True
+        else:
+            subtitle = (subtitle[0], subtitle[1], subtitles.format_subtitle(
+                subtitle[2], self.split_sub_lines))
+            realtime = False
+        if batched is None:
+            batched = self.recording
+        subtitle_start, subtitle_duration, text = subtitle
+
+        if not self.processed_ids.wait(0):
+            # Checking whether the clip is processed would block until the
+            # ids are loaded
+            logger.info("Picking the subtitle at %.2fs once the processed "
+                        "clips are loaded", float(subtitle_start) /
+                        clips.SECOND)
+            self.deferred.append(subtitle)
+            return None
+
+        clip = self.new_clip(subtitle)
+        if clip is None:
+            return None
+        id = clip['id']
+        self.processing.add(id)
+        self.changed()
+        if self.jobs is not None:
+            # Added on the adder's thread, see jobs_added()
+            self.job_batch.append((id, self.filename, {
+                'clip': clip, 'video': self.filename,
+                'start': float(subtitle_start) / clips.SECOND,
+                'duration': float(subtitle_duration) / clips.SECOND,
+                'frame_size': self.frame_size,
+                'framerate': self.framerate}))
+            if not batched or len(self.job_batch) >= self.batch.max_clips:
+                self.extract_batch()
+            return clip
+
+        # Clips are saved once their frames are on disk
+        if self.capture is not None and self.recording and realtime:
+            # Write the full frames as they are decoded for playback
+            self.capture.add(clip, clips.image_pattern(self.config, id),
+                             subtitle_start,
+                             subtitle_start + subtitle_duration,
+                             self.on_extracted)
+            return clip
+
+        # Extract the image sequence for this subtitle with ffmpeg. Batched
+        # clips are extracted with one decode.
+        output = clips.extraction_output(self.config, clip, self.frame_size,
+                                         self.framerate)
+        self.batch.add(clip, output, float(subtitle_start) / clips.SECOND,
+                       float(subtitle_duration) / clips.SECOND)
+        if not batched or self.batch.full():
+            self.extract_batch()
+        return clip
+
+    def pick_deferred(self):
+        """Pick the subtitles deferred by pick(), once the processed ids
+        are loaded. They are extracted with ffmpeg, like indexed ones."""
+        deferred, self.deferred = self.deferred, []
+        picked = [self.pick(subtitle, batched=True) for subtitle in deferred]
+        self.extract_batch()
+        return [clip for clip in picked if clip is not None]
+
+    def jobs_added(self, jobs, added):
+        """Forget the picked clips that weren't added to the job queue."""
+        added = set(added)
+        for id, video, payload in jobs:
+            if id not in added:
+                # Another picker added the clip first, or the queue failed
+                logger.debug("Clip %s is already queued. Not saving.", id)
+                self.processing.discard(id)
+        self.changed()
+
+    def extract_batch(self):
+        if self.job_batch:
+            self.jobs.add(self.job_batch)
+            self.job_batch = []
+        job = self.batch.job(self.on_extracted)
+        if job is not None and self.submit is not None:
+            self.submit(job)
+        return job
+
+    def finish_job(self, job):
+        """(clip, frame count) of every clip of a finished job to save."""
+        for clip in job.clips:
+            self.processing.discard(clip['id'])
+
+        if not job.ok:
+            logger.error("Extraction failed: " + job.error)
+
+        extracted = job.extracted()
+        for clip, frames in extracted:
+            self.processed_ids.add(clip['id'])
+        self.changed()
+        return extracted
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+Bounded pool of ffmpeg frame extraction jobs
+"""
+
+import logging
+import os
+import pipes
+import queue
+import subprocess
+import threading
+import time
+
+import clips
+
+logger = logging.getLogger(__name__)
+
+
+def count_frames(output):
+    """Number of frames written for a clips.ExtractionOutput."""
+    if output.frame_bytes:
+        if not os.path.isfile(output.path):
+            return 0
+        return os.path.getsize(output.path) // output.frame_bytes
+
+    # Consecutive images of the sequence
+    count = 0
+    while os.path.isfile(output.path % (count + 1)):
+        count += 1
+    return count
+
+
+class ExtractionJob:
+    """One ffmpeg run writing the frames of one or more clips.
+
+    start is the time in the video where the command's timestamps start,
+    to map sampled frames back to video frames.
+    """
+
+    def __init__(self, clips, command, outputs, callback=None, store=None,
+                 start=0.0):
+        self.clips = clips
+        self.command = command
+        self.outputs = outputs
+        self.callback = callback
+        self.store = store
+        self.start = start
+
+        self.returncode = None
+        self.error = None
+        self.frames = [0] * len(clips)
+        self.duration = 0.0
+        self.done = threading.Event()
+
+    @property
+    def ok(self):
+        return self.done.is_set() and self.error is None
+
+    def name(self):
+        if len(self.clips) == 1:
+            return self.outputs[0].path
+        return str(len(self.clips)) + " clips from " + self.outputs[0].path
+
+    def extracted(self):
+        """(clip, frame count) for every clip whose frames are on disk."""
+        if self.returncode != 0:
+            return []
+        return [(clip, frames) for clip, frames in zip(self.clips, self.frames)
+                if frames > 0]
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def pack(self):
+        """Move the extracted image sequences into the packed store."""
+        for clip, output, frames in zip(self.clips, self.outputs,
+                                        self.frames):
+            if not frames or output.frame_bytes:
+                continue
+            self.store.append_files(
+                clip['id'], [output.path % (i + 1) for i in range(frames)],
+                delete=True)
+            clip['frames'] = {'pack': os.path.relpath(self.store.path),
+                              'count': frames}
+
+    def map_frames(self, log):
+        """Record the video frame of every sampled frame in its clip."""
+        maps = clips.frame_maps(log, self.outputs, self.start)
+        for clip, output, frames, frame_map in zip(
+                self.clips, self.outputs, self.frames, maps):
+            if output.framerate is None:
+                continue
+            if len(frame_map) != frames:
+                logger.warning("Logged %d of the %d frames of clip %s",
+                               len(frame_map), frames, clip['id'])
+            clip['frame_map'] = frame_map
+
+    def run(self):
+        started = time.time()
+        try:
+            for output in self.outputs:
+                os.makedirs(os.path.dirname(output.path), exist_ok=True)
+            process = subprocess.run(self.command, stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.PIPE)
+            self.returncode = process.returncode
+            log = process.stderr.decode('UTF-8', 'replace')
+            if process.returncode != 0:
+                if '-hide_banner' in self.command:
+                    # Logged at the info level, the error is at the end
+                    log = '\n'.join(line for line in log.splitlines()[-10:]
+                                     if 'showinfo@' not in line)
+                self.error = ("ffmpeg exited with code "
+                              + str(process.returncode) + ": "
+                              + log.strip())
+            else:
+                self.frames = [count_frames(output) for output in self.outputs]
+                for clip, frames in zip(self.clips, self.frames):
+                    if 'frames' in clip:
+                        clip['frames']['count'] = frames
+                self.map_frames(log)
+                if self.store is not None:
+                    self.pack()
+                missing = self.frames.count(0)
+                if missing:
+                    self.error = ("ffmpeg wrote no frames for " + str(missing)
+                                  + " of " + str(len(self.clips)) + " clips")
+        except OSError as e:
+            self.error = str(e)
+        self.duration = time.time() - started
+
+
+class ExtractionQueue:
+    """Runs extraction jobs on a fixed number of worker threads.
+
+    submit() blocks while max_pending jobs are waiting, so producers can't
+    get ahead of the workers; with block=False it raises queue.Full
+    instead. Every job's callback is called from its
+    worker thread once the job is finished, whether it failed or not.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.jobs = queue.Queue(maxsize=max_pending or 4 * self.workers)
+        self.running = 0
+        self.lock = threading.Lock()
+
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work,
+                                      name='extraction-' + str(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job, block=True, timeout=None):
+        self.jobs.put(job, block, timeout)
+        logger.info(" ".join([pipes.quote(c) for c in job.command]))
+        return job
+
+    def pending(self):
+        """Number of jobs queued or running."""
+        return self.jobs.qsize() + self.running
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            with self.lock:
+                self.running += 1
+            try:
+                job.run()
+                if job.error is None:
+                    logger.info("Extracted %d frames for %s in %.1fs",
+                                sum(job.frames), job.name(), job.duration)
+                else:
+                    logger.error("Extraction failed for %s: %s",
+                                 job.name(), job.error)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                job.done.set()
+                self.jobs.task_done()
+
+            if job.callback is not None:
+                try:
+                    job.callback(job)
+                except Exception:
+                    logger.exception("Extraction callback failed")
+
+    def join(self):
+        """Wait until every submitted job is finished."""
+        self.jobs.join()
+
+    def close(self):
+        """Finish all submitted jobs and stop the workers."""
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class ExtractionBatch:
+    """Collects clips of one video to extract them with a single decode.
+
+    Best filled with the clips of one scene: everything between the first
+    start and the last end is decoded, so far apart clips waste work.
+    """
+
+    def __init__(self, filename, max_clips=16, store=None):
+        self.filename = filename
+        self.max_clips = max_clips
+        self.store = store
+        self.segments = []
+        self.clips = []
+
+    def __len__(self):
+        return len(self.clips)
+
+    def full(self):
+        return len(self.clips) >= self.max_clips
+
+    def add(self, clip, output, start, duration):
+        self.clips.append(clip)
+        self.segments.append((output, start, duration))
+
+    def job(self, callback=None):
+        """Turn the collected clips into one job and start a new batch."""
+        if not self.clips:
+            return None
+
+        job = ExtractionJob(
+            self.clips,
+            clips.batch_extraction_command(self.filename, self.segments),
+            [output for output, _, _ in self.segments],
+            callback, self.store,
+            min(start for _, start, _ in self.segments))
+        self.clips = []
+        self.segments = []
+        return job
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Extract every scene-aligned subtitle clip from a video, without a display
+
+Drives the same engine as the picker, so the rules of record mode apply: a
+subtitle becomes a clip when it lies completely within one scene and is
+long enough. Clips are stored with common.data_utils.ClipWriter, like the
+picker does.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import threading
+
+import common.data_utils
+import engine
+import extraction
+import registry
+import scenes
+import subtitles
+
+logger = logging.getLogger(__name__)
+
+
+def probe_video(filename):
+    """(framerate, width, height, duration) of the first video stream."""
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,r_frame_rate:format=duration',
+        '-of', 'json',
+        filename
+    ]
+    info = json.loads(subprocess.check_output(command).decode('UTF-8'))
+    stream = info['streams'][0]
+    numerator, denominator = stream['r_frame_rate'].split('/')
+    framerate = float(numerator) / float(denominator)
+    return (framerate, int(stream['width']), int(stream['height']),
+            float(info['format']['duration']))
+
+
+def load_scenes(filename, scene_file=None, threshold=0.4):
+    if scene_file is None:
+        # <video>.json, or detected scenes when there is none
+        return scenes.load_scene_index(filename, threshold=threshold)
+
+    return scenes.SceneIndex(scenes.read_probe_timestamps(scene_file))
+
+
+def extract(filename, config, save, scene_file=None, subtitle_file=None,
+            subtitle_stream=0, scale=4.5, center=None, split_sub_lines=False,
+            workers=None, batch_size=16, processed_ids=(), planned=None):
+    """Extract the aligned clips of a video that aren't processed yet.
+
+    save(job) is called from the extraction threads with every finished
+    extraction.ExtractionJob, after PickerEngine.finish_job, and
+    planned(count) with the number of clips to extract before the first
+    one starts. Returns that number.
+    """
+    framerate, width, height, duration = probe_video(filename)
+    if center is None:
+        center = (width / 2.0, height / 2.0)
+
+    scene_index = load_scenes(filename, scene_file,
+                              config.get('scene_threshold', 0.4))
+    subtitle_list = subtitles.load_subtitles(filename, subtitle_file,
+                                             subtitle_stream)
+
+    queue = extraction.ExtractionQueue(workers)
+    finish_lock = threading.Lock()
+
+    def finished(job):
+        # Drops the clips from picker.processing, which would otherwise
+        # keep the id of every clip of the video
+        with finish_lock:
+            picker.finish_job(job)
+        save(job)
+
+    picker = engine.PickerEngine(
+        dict(config, extraction_batch_size=batch_size),
+        registry.ClipRegistry(lambda: processed_ids), queue.submit, finished)
+    picker.processed_ids.load_ids()
+    picker.open(filename, framerate, (width, height))
+    picker.detection_scale = scale
+    picker.center = center
+    picker.split_sub_lines = split_sub_lines
+    picker.set_scenes(scene_index)
+    picker.set_subtitle_index(subtitles.SubtitleIndex(subtitle_list))
+
+    scene_list = list(scene_index.intervals(duration))
+    count = sum(len(picker.scene_clips(*scene)) for scene in scene_list)
+    logger.info("%d scenes, %d subtitles, %d clips to extract",
+                len(scene_index), len(subtitle_list), count)
+    if planned is not None:
+        planned(count)
+
+    # Clips of one scene are extracted together, with a single decode
+    try:
+        for scene in scene_list:
+            picker.pick_scene(*scene)
+    finally:
+        queue.close()
+        if picker.batch.store is not None:
+            picker.batch.store.close()
+
+    return count
+
+
+def run(filename, config_file='config.json', scene_file=None,
+        subtitle_file=None, subtitle_stream=0, scale=4.5, center=None,
+        split_sub_lines=False, workers=None, batch_size=16):
+    with open(config_file) as f:
+        config = json.load(f)
+
+    writer = common.data_utils.ClipWriter()
+    writer_lock = threading.Lock()
+    saved = []
+
+    def save_clips(job):
+        with writer_lock:
+            for clip, frames in job.extracted():
+                writer.send(clip)
+                saved.append(clip['id'])
+
+    try:
+        extract(filename, config, save_clips, scene_file, subtitle_file,
+                subtitle_stream, scale, center, split_sub_lines, workers,
+                batch_size, common.data_utils.get_clip_ids())
+    finally:
+        writer.close()
+
+    logger.info("Saved %d clips", len(saved))
+    return len(saved)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('video')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--scenes', help="ffprobe scene info (default: "
+                        "<video>.json, or detect scenes if there is none)")
+    parser.add_argument('--subtitles', help="subtitle file "
+                        "(default: the embedded subtitle track)")
+    parser.add_argument('--subtitle-stream', type=int, default=0,
+                        help="index of the embedded subtitle track")
+    parser.add_argument('--scale', type=float, default=4.5,
+                        help="detection scale stored with every clip")
+    parser.add_argument('--center', type=float, nargs=2,
+                        metavar=('X', 'Y'), help="detection center in video "
+                        "pixels (default: center of the frame)")
+    parser.add_argument('--split-sub-lines', action='store_true',
+                        help="only keep the last line of every subtitle")
+    parser.add_argument('--workers', type=int,
+                        help="concurrent ffmpeg extractions "
+                        "(default: number of cores)")
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help="maximum number of clips extracted with one "
+                        "decode")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run(os.path.abspath(args.video), args.config, args.scenes, args.subtitles,
+        args.subtitle_stream, args.scale, args.center, args.split_sub_lines,
+        args.workers, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
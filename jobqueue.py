@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+
+"""
+Persistent queue of clip extraction jobs, shared by pickers and workers
+
+Adding a clip to the queue claims its id: the add fails when any picker
+already added it, so annotators working on the same videos never extract a
+clip twice. Workers, in the picker or in other processes and machines (see
+main() below), lease jobs for a while, keep the lease alive while ffmpeg
+runs, and hand back the clip record. Leases of crashed workers expire and
+the jobs are retried. Every picker collects the finished clips it added and
+saves them like clips it extracted itself.
+
+The default backend is an SQLite database in WAL mode, for pickers and
+workers on one host: WAL needs memory shared between the processes, which
+network file systems don't provide. A database on a network file system
+needs journal_mode=DELETE (see open_queue) and locks that work over it,
+which many don't have. Pickers and workers on several machines should use
+a server backend instead; backends register themselves in BACKENDS.
+"""
+
+import abc
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import clips
+import extraction
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    video TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    frames INTEGER,
+    error TEXT,
+    collected INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, collected, state);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    clips INTEGER NOT NULL DEFAULT 0,
+    frames INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    last_seen REAL
+);
+"""
+
+
+def default_owner(config_file='config.json'):
+    """Name of a picker that stays the same between sessions."""
+    return socket.gethostname() + ':' + os.path.abspath(config_file)
+
+
+class FinishedJobs:
+    """Clips finished by workers, to pass to PickerEngine.finish_job.
+
+    Like an extraction.ExtractionJob: clips are all clips, extracted() the
+    ones whose frames are on disk with their frame count.
+    """
+
+    def __init__(self):
+        self.clips = []
+        self.frames = []
+        self.errors = []
+
+    def __len__(self):
+        return len(self.clips)
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    @property
+    def error(self):
+        return '; '.join(self.errors) or None
+
+    def extracted(self):
+        return [(clip, frames) for clip, frames in zip(self.clips,
+                                                       self.frames)
+                if frames > 0]
+
+
+class JobQueue(abc.ABC):
+    """Interface of the queue backends.
+
+    A job is the id of a clip with a payload: the clip record and what's
+    needed to extract it, see PickerEngine.pick. Jobs are 'queued', 'leased'
+    by a worker, then 'done' or 'failed'.
+    """
+
+    @abc.abstractmethod
+    def add(self, id, video, payload):
+        """Queue a job, unless its clip was added before. Returns whether it
+        was added. Failed jobs can be added again."""
+
+    def add_many(self, jobs):
+        """Queue (id, video, payload) jobs like add(). Returns the ids of
+        the ones that were added."""
+        return [id for id, video, payload in jobs
+                if self.add(id, video, payload)]
+
+    @abc.abstractmethod
+    def lease(self, worker, limit=1, seconds=60.0):
+        """Up to limit (id, payload) of queued jobs of one video, leased to
+        worker for seconds. Jobs with expired leases count as queued."""
+
+    @abc.abstractmethod
+    def heartbeat(self, worker, ids, seconds=60.0):
+        """Extend the leases of worker on ids."""
+
+    @abc.abstractmethod
+    def complete(self, worker, id, clip, frames):
+        """Store the extracted clip record. Returns False when the lease was
+        lost, to another worker or because it expired."""
+
+    @abc.abstractmethod
+    def fail(self, worker, id, error):
+        """Queue a job again, or fail it after too many attempts."""
+
+    @abc.abstractmethod
+    def report(self, worker, clips, frames, failures, seconds):
+        """Add to the throughput stats of a worker."""
+
+    @abc.abstractmethod
+    def collect(self):
+        """FinishedJobs with the jobs of this owner that are done or failed
+        since the last collect."""
+
+    @abc.abstractmethod
+    def counts(self):
+        """Number of jobs by state."""
+
+    @abc.abstractmethod
+    def stats(self):
+        """Throughput stats of every worker, as dicts."""
+
+    def close(self):
+        pass
+
+
+# Journal modes that keep the database consistent between processes
+JOURNAL_MODES = ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST')
+
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue in an SQLite database, safe to share between processes.
+
+    Keep the database on a local disk with the default WAL journal_mode,
+    see the module docstring.
+    """
+
+    def __init__(self, path, owner=None, max_attempts=3, journal_mode='WAL'):
+        if journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError("Unsupported journal mode " + journal_mode)
+        self.path = path
+        self.owner = owner or default_owner()
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+        # Transactions are started explicitly, to take the write lock first
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        mode = self.db.execute('PRAGMA journal_mode=' +
+                               journal_mode).fetchone()[0]
+        if mode.upper() != journal_mode.upper():
+            logger.warning("Job queue %s uses journal mode %s instead of %s",
+                           path, mode, journal_mode)
+        # NORMAL is only safe from corruption with WAL
+        self.db.execute('PRAGMA synchronous=' +
+                        ('NORMAL' if mode.upper() == 'WAL' else 'FULL'))
+        self.db.executescript(SCHEMA)
+
+    def transaction(self, function, *args):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(*args)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def add(self, id, video, payload):
+        return self.transaction(self._add, id, video, json.dumps(payload))
+
+    def add_many(self, jobs):
+        # One transaction for all of them
+        def add_all():
+            return [id for id, video, payload in jobs
+                    if self._add(id, video, json.dumps(payload))]
+        return self.transaction(add_all)
+
+    def _add(self, id, video, payload):
+        now = time.time()
+        row = self.db.execute('SELECT state FROM jobs WHERE id = ?',
+                              (id,)).fetchone()
+        if row is None:
+            self.db.execute(
+                'INSERT INTO jobs (id, owner, video, payload, state, '
+                'created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (id, self.owner, video, payload, 'queued', now, now))
+            return True
+        if row['state'] != 'failed':
+            return False
+        self.db.execute(
+            "UPDATE jobs SET owner = ?, video = ?, payload = ?, "
+            "state = 'queued', worker = NULL, lease_until = NULL, "
+            "attempts = 0, result = NULL, frames = NULL, error = NULL, "
+            "collected = 0, updated = ? WHERE id = ?",
+            (self.owner, video, payload, now, id))
+        return True
+
+    def lease(self, worker, limit=1, seconds=60.0):
+        return self.transaction(self._lease, worker, limit, seconds)
+
+    def _lease(self, worker, limit, seconds):
+        now = time.time()
+        # Workers that died on a job too often
+        self.db.execute(
+            "UPDATE jobs SET state = 'failed', updated = ?, "
+            "error = 'lease expired ' || attempts || ' times' "
+            "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, now, self.max_attempts))
+
+        leasable = ("(state = 'queued' OR (state = 'leased' AND "
+                    "lease_until < ?))")
+        first = self.db.execute(
+            'SELECT video FROM jobs WHERE ' + leasable +
+            ' ORDER BY created LIMIT 1', (now,)).fetchone()
+        if first is None:
+            return []
+
+        # Jobs of one video can be extracted together
+        rows = self.db.execute(
+            'SELECT id, payload FROM jobs WHERE video = ? AND ' + leasable +
+            ' ORDER BY created LIMIT ?', (first['video'], now, limit)
+        ).fetchall()
+        self.db.executemany(
+            "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+            "attempts = attempts + 1, updated = ? WHERE id = ?",
+            [(worker, now + seconds, now, row['id']) for row in rows])
+        return [(row['id'], json.loads(row['payload'])) for row in rows]
+
+    def heartbeat(self, worker, ids, seconds=60.0):
+        def extend():
+            now = time.time()
+            self.db.executemany(
+                "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? "
+                "AND worker = ? AND state = 'leased'",
+                [(now + seconds, now, id, worker) for id in ids])
+            self._seen(worker, now)
+        self.transaction(extend)
+
+    def _owned(self, worker, id):
+        row = self.db.execute(
+            "SELECT attempts FROM jobs WHERE id = ? AND worker = ? AND "
+            "state = 'leased' AND lease_until >= ?",
+            (id, worker, time.time())).fetchone()
+        return row
+
+    def complete(self, worker, id, clip, frames):
+        def done():
+            if self._owned(worker, id) is None:
+                return False
+            self.db.execute(
+                "UPDATE jobs SET state = 'done', result = ?, frames = ?, "
+                "lease_until = NULL, updated = ? WHERE id = ?",
+                (json.dumps(clip), frames, time.time(), id))
+            return True
+        return self.transaction(done)
+
+    def fail(self, worker, id, error):
+        def failed():
+            row = self._owned(worker, id)
+            if row is None:
+                return False
+            state = ('failed' if row['attempts'] >= self.max_attempts
+                     else 'queued')
+            self.db.execute(
+                "UPDATE jobs SET state = ?, error = ?, lease_until = NULL, "
+                "updated = ? WHERE id = ?", (state, error, time.time(), id))
+            return True
+        return self.transaction(failed)
+
+    def _seen(self, worker, now):
+        self.db.execute(
+            'INSERT OR IGNORE INTO workers (name) VALUES (?)', (worker,))
+        self.db.execute('UPDATE workers SET last_seen = ? WHERE name = ?',
+                        (now, worker))
+
+    def report(self, worker, clips, frames, failures, seconds):
+        def add():
+            self._seen(worker, time.time())
+            self.db.execute(
+                'UPDATE workers SET clips = clips + ?, frames = frames + ?, '
+                'failures = failures + ?, seconds = seconds + ? '
+                'WHERE name = ?', (clips, frames, failures, seconds, worker))
+        self.transaction(add)
+
+    def collect(self):
+        return self.transaction(self._collect)
+
+    def _collect(self):
+        finished = FinishedJobs()
+        rows = self.db.execute(
+            "SELECT id, payload, state, result, frames, error FROM jobs "
+            "WHERE owner = ? AND collected = 0 AND state IN ('done', "
+            "'failed')", (self.owner,)).fetchall()
+        for row in rows:
+            if row['state'] == 'done':
+                finished.clips.append(json.loads(row['result']))
+                finished.frames.append(row['frames'])
+            else:
+                finished.clips.append(json.loads(row['payload'])['clip'])
+                finished.frames.append(0)
+                finished.errors.append(row['id'] + ': ' + str(row['error']))
+        self.db.executemany('UPDATE jobs SET collected = 1 WHERE id = ?',
+                            [(row['id'],) for row in rows])
+        return finished
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def stats(self):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT * FROM workers ORDER BY name').fetchall()
+        stats = []
+        for row in rows:
+            stat = dict(row)
+            seconds = max(row['seconds'], 1e-9)
+            stat['clips_per_s'] = row['clips'] / seconds
+            stat['frames_per_s'] = row['frames'] / seconds
+            stats.append(stat)
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Backends by the scheme of their location, like sqlite:///jobs.db
+BACKENDS = {'sqlite': SQLiteJobQueue}
+
+
+def open_queue(location, owner=None, max_attempts=3):
+    """JobQueue at location, a URL or the path of an SQLite database.
+
+    The query of a URL is passed to the backend as keyword arguments, like
+    sqlite:///mnt/shared/jobs.db?journal_mode=DELETE.
+    """
+    scheme, path = 'sqlite', location
+    options = {}
+    if '://' in location:
+        scheme, path = location.split('://', 1)
+        path, _, query = path.partition('?')
+        options = dict(urllib.parse.parse_qsl(query))
+    if scheme not in BACKENDS:
+        raise ValueError("Unknown job queue backend " + scheme)
+    return BACKENDS[scheme](path, owner, max_attempts, **options)
+
+
+class JobAdder:
+    """Adds jobs to a queue on a background thread, a batch at a time.
+
+    on_added(jobs, added) is called from that thread with every batch of
+    (id, video, payload) jobs and the ids that were added, which are none
+    when the queue failed.
+    """
+
+    def __init__(self, jobs, on_added):
+        self.jobs = jobs
+        self.on_added = on_added
+        self.batches = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='job-adder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, jobs):
+        self.batches.put(list(jobs))
+
+    def run(self):
+        while True:
+            jobs = self.batches.get()
+            if jobs is None:
+                return
+            try:
+                added = self.jobs.add_many(jobs)
+            except sqlite3.Error:
+                logger.exception("Could not add %d clips to the job queue",
+                                 len(jobs))
+                added = []
+            self.on_added(jobs, added)
+
+    def close(self, timeout=None):
+        """Add the batches given so far, then stop. Returns whether that
+        finished within timeout."""
+        self.batches.put(None)
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+class Worker:
+    """Leases jobs from a queue and extracts them with ffmpeg.
+
+    Jobs of one video are leased and extracted together, up to batch_size.
+    Frames are written to the image_root of config, which all pickers and
+    workers need to share.
+    """
+
+    def __init__(self, jobs, config, name=None, batch_size=16,
+                 lease_seconds=60.0):
+        self.jobs = jobs
+        self.config = config
+        self.name = name or socket.gethostname() + ':' + str(os.getpid())
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        if config.get('pack_store', False):
+            logger.warning("Workers don't write to packed frame stores")
+
+    def run_once(self):
+        """Extract one batch of jobs. Returns False when none are queued."""
+        leased = self.jobs.lease(self.name, self.batch_size,
+                                 self.lease_seconds)
+        if not leased:
+            return False
+
+        batch = extraction.ExtractionBatch(leased[0][1]['video'],
+                                           len(leased))
+        ids = []
+        for id, payload in leased:
+            clip = payload['clip']
+            output = clips.extraction_output(self.config, clip,
+                                             payload['frame_size'],
+                                             payload['framerate'])
+            batch.add(clip, output, payload['start'], payload['duration'])
+            ids.append(id)
+        job = batch.job()
+        logger.info("Extracting %d clips of %s", len(ids), batch.filename)
+
+        # Keep the leases while ffmpeg runs
+        finished = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(self.lease_seconds / 3.0):
+                try:
+                    self.jobs.heartbeat(self.name, ids, self.lease_seconds)
+                except sqlite3.Error:
+                    logger.exception("Could not extend the job leases")
+        thread = threading.Thread(target=heartbeat, name='job-heartbeat')
+        thread.daemon = True
+        thread.start()
+        try:
+            job.run()
+        finally:
+            finished.set()
+            thread.join()
+
+        failures = 0
+        for id, clip, frames in zip(ids, job.clips, job.frames):
+            if job.returncode == 0 and frames > 0:
+                if not self.jobs.complete(self.name, id, clip, frames):
+                    logger.warning("Lost the lease of clip %s", id)
+            else:
+                failures += 1
+                self.jobs.fail(self.name, id, job.error or "no frames")
+        self.jobs.report(self.name, len(ids) - failures, sum(job.frames),
+                         failures, job.duration)
+        return True
+
+    def run(self, idle=1.0):
+        """Extract jobs until stop() is called, polling every idle seconds
+        while none are queued."""
+        while not self.stopped.is_set():
+            try:
+                if not self.run_once():
+                    self.stopped.wait(idle)
+            except sqlite3.Error:
+                logger.exception("Job queue error")
+                self.stopped.wait(idle)
+
+    def start(self):
+        thread = threading.Thread(target=self.run,
+                                  name='job-worker-' + self.name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract clips from a shared job queue, or show its "
+        "stats")
+    parser.add_argument('command', choices=('work', 'stats'))
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--queue', help="job queue location, by default "
+                        "job_queue in the config file")
+    parser.add_argument('--name', help="worker name, by default "
+                        "<host>:<pid>")
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--once', action='store_true',
+                        help="stop once no jobs are queued")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config) as f:
+        config = json.load(f)
+    config.pop('clips', None)
+    location = args.queue or config.get('job_queue')
+    if not location:
+        parser.error("no --queue given and no job_queue in " + args.config)
+    jobs = open_queue(location, max_attempts=config.get('job_max_attempts',
+                                                        3))
+
+    if args.command == 'stats':
+        counts = jobs.counts()
+        print(", ".join("{0} {1}".format(state, counts[state])
+                        for state in sorted(counts)) or "no jobs")
+        for stat in jobs.stats():
+            print("{name}: {clips} clips, {frames} frames, {failures} "
+                  "failed, {clips_per_s:.2f} clips/s, {frames_per_s:.1f} "
+                  "frames/s".format(**stat))
+        return
+
+    worker = Worker(jobs, config, args.name,
+                    args.batch_size or config.get('extraction_batch_size', 16),
+                    config.get('job_lease_seconds', 60))
+    try:
+        if args.once:
+            while worker.run_once():
+                pass
+        else:
+            worker.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        jobs.close()
+
+
+if __name__ == '__main__':
+    main()
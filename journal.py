@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Append-only journal of saved clips, compacted into the config file
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def read_journal(path):
+    """Clips recorded in a journal file, ignoring a torn last line."""
+    clips = []
+    if not os.path.isfile(path):
+        return clips
+
+    with open(path, encoding='UTF-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                clips.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping incomplete journal entry in %s", path)
+    return clips
+
+
+class ClipJournal:
+    """Records new clips as JSON lines next to the config file.
+
+    Appends are flushed to disk every sync_every clips or sync_interval
+    seconds, whichever comes first. Every compact_every clips the journal
+    is moved aside and merged into the 'clips' of the config file on a
+    background thread, while new clips go to a new journal. The config
+    file is replaced atomically. close() merges whatever is left.
+    """
+
+    def __init__(self, config_file, sync_every=16, sync_interval=5.0,
+                 compact_every=1000):
+        self.config_file = config_file
+        self.path = config_file + '.journal'
+        # Journal being merged into the config file
+        self.compacting_path = config_file + '.journal.compacting'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.compactor = None
+
+        self.entries = len(read_journal(self.path))
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.file = open(self.path, 'a', encoding='UTF-8')
+
+        if self.entries or os.path.isfile(self.compacting_path):
+            # Left over from a previous session that didn't close cleanly
+            logger.info("Recovering clips from %s", self.path)
+            self.start_compaction()
+
+    def append(self, clip):
+        with self.lock:
+            self.file.write(json.dumps(clip) + '\n')
+            self.entries += 1
+            self.unsynced += 1
+            if (self.unsynced >= self.sync_every or
+                    time.time() - self.last_sync >= self.sync_interval):
+                self._sync()
+
+        if self.entries >= self.compact_every:
+            self.start_compaction()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+        return True  # Keep running when used as a GLib timeout
+
+    def _sync(self):
+        if self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.time()
+
+    def _rotate(self):
+        """Move the journal aside for compaction and start a new one."""
+        with self.lock:
+            self._sync()
+            if self.entries and not os.path.isfile(self.compacting_path):
+                self.file.close()
+                os.replace(self.path, self.compacting_path)
+                self.file = open(self.path, 'a', encoding='UTF-8')
+                self.entries = 0
+
+    def start_compaction(self):
+        """Compact on a background thread, unless it already runs."""
+        if self.compactor is not None and self.compactor.is_alive():
+            return
+        self._rotate()
+        self.compactor = threading.Thread(target=self._compact_logged,
+                                          name='journal-compactor')
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    def _compact_logged(self):
+        # The journal moved aside is kept, and merged by the next compaction
+        try:
+            self.compact()
+        except Exception:
+            logger.exception("Could not compact %s", self.compacting_path)
+
+    def compact(self):
+        """Merge the moved aside journal into the config file."""
+        new_clips = read_journal(self.compacting_path)
+        if new_clips:
+            with open(self.config_file) as f:
+                config = json.load(f)
+            clips = config.setdefault('clips', [])
+            ids = set(clip['id'] for clip in clips)
+            clips.extend(clip for clip in new_clips if clip['id'] not in ids)
+
+            temporary_file = self.config_file + '.tmp'
+            with open(temporary_file, 'w') as f:
+                json.dump(config, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_file, self.config_file)
+            logger.info("Compacted %d clips into %s", len(new_clips),
+                        self.config_file)
+        if os.path.isfile(self.compacting_path):
+            os.remove(self.compacting_path)
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.join()
+        self._rotate()
+        self.compact()
+        self.file.close()
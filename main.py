@@ -4,31 +4,61 @@
 Application to pick single-sentence clips from a video
 """
 
-import datetime
 import sys
 import os
-import shutil
-import shlex
-import pipes
-import subprocess
+import collections
 import json
-import math
 import logging
+import queue
+import socket
+import sqlite3
+import threading
+import time
 
-import cairo
 import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('GstVideo', '1.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('GdkX11', '3.0')
-gi.require_foreign('cairo')
+gi.require_foreign('cairo')  # Imports cairo, for the cairooverlay draw signal
 from gi.repository import Gst, GObject, Gtk, GdkX11, GstVideo, GLib, Gdk  # noqa: E402
 
-import common.data_utils
+import capture
+import engine
+import extraction
+import jobqueue
+import journal
+import metrics
+import proxy
+import registry
+import scenes
+import seeking
+import subtitles
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# What on_draw_scale_preview draws, valid while the inputs are unchanged and
+# playback stays within [scene_low, scene_high)
+OverlayState = collections.namedtuple('OverlayState', [
+    'version', 'scene_low', 'scene_high', 'center_x', 'center_y', 'top_x',
+    'top_y', 'edge_length', 'alpha', 'color'])
+
+
+class FrameTimer:
+    """Average and maximum of the last frame times."""
+
+    def __init__(self, window=120):
+        self.times = collections.deque(maxlen=window)
+
+    def add(self, seconds):
+        self.times.append(seconds)
+
+    def __str__(self):
+        if not self.times:
+            return "draw: -"
+        return "draw: {0:.2f} ms avg, {1:.2f} ms max".format(
+            1000 * sum(self.times) / len(self.times), 1000 * max(self.times))
+
 
 class Main:
 
@@ -37,33 +67,196 @@ class Main:
         self.config = {}
         with open(config_file) as config_file:
             self.config = json.load(config_file)
+        # Clips are appended to the journal, they don't need to stay loaded
+        self.config.pop('clips', None)
+        logging.getLogger().setLevel(self.config.get('log_level', 'INFO'))
 
         self.video_scale = 1.0
         self.video_margin = (0, 0)
-        self.center_position = (0, 0)
-        self.detection_scale = 4.5
+        self.preview_size = None
+        self.preview_scale = 1.0
         self.gst_src = None
         self.window_size = (50, 50)
+        self.seeks = seeking.SeekScheduler(self.start_seek)
+        self.scrubbing = False
+
+        # Played instead of the video when set, see proxy. Clips are still
+        # extracted from the video, in its coordinates: source_scale is the
+        # size of the played frames relative to the video.
+        self.proxy = None
+        self.subtitle_file = None
+        self.source_scale = 1.0
+        self.resume_position = None
 
         self.build_gst()
         self.build_ui()
 
-        self.filename = ''
-        self.scenes = []
-        self.framerate = 1.0
-        self.current_subtitle = ""
-        self.current_subtitle_duration = 0
-        self.current_subtitle_start = 0
+        self.overlay = None
+        self.overlay_version = 0
+        self.draw_timer = FrameTimer()
+        self.show_draw_time = self.config.get('show_draw_time', False)
+
+        # Started in the background once the window is shown
+        self.processed_clip_ids = registry.ClipRegistry(
+            self.load_clip_ids,
+            lambda: GLib.idle_add(self.on_clip_ids_loaded))
+        self.writer = None
+        self.writer_ready = threading.Event()
+        # Clips saved before the writer is ready, sent once it is
+        self.unwritten_clips = []
+        GLib.idle_add(self.start_background_services)
+
+        self.journal = journal.ClipJournal(
+            self.config_file,
+            compact_every=self.config.get('journal_compact_every', 1000))
+        GLib.timeout_add_seconds(5, self.journal.sync)
+
+        self.extraction = extraction.ExtractionQueue(
+            self.config.get('extraction_workers'),
+            self.config.get('extraction_queue_size'))
+        self.extracted_jobs = queue.Queue()
+        # Jobs submitted while the extraction queue is full, submitted as
+        # extractions finish instead of blocking the main loop
+        self.unsubmitted_jobs = collections.deque()
+
+        # Clips are extracted by the workers of a shared queue instead, and
+        # collected from it when they're done
+        self.jobs = None
+        self.job_workers = []
+        self.job_threads = []
+        self.job_collector = None
+        self.job_adder = None
+        if self.config.get('job_queue'):
+            self.start_job_queue()
+
+        # Scenes, subtitles and the clip rules, driven by the UI
+        self.engine = engine.PickerEngine(
+            self.config, self.processed_clip_ids, self.submit_job,
+            self.on_clip_extracted, self.invalidate_overlay, self.capture,
+            self.job_adder)
+
+        self.build_metrics()
+
+    def build_metrics(self):
+        self.metrics = metrics.Metrics()
+        self.draw_time = self.metrics.timer(
+            'draw_seconds', "Duration of the scale preview draw callback")
+        self.subtitle_latency = self.metrics.timer(
+            'subtitle_latency_seconds',
+            "Time from a subtitle sample to its handling on the main loop")
+        self.scene_lookup_time = self.metrics.timer(
+            'scene_lookup_seconds',
+            "Duration of scene lookups by get_scene and the overlay")
+        self.extraction_time = self.metrics.timer(
+            'extraction_seconds', "Duration of ffmpeg extraction jobs")
+        self.frames_written = self.metrics.counter(
+            'frames_written', "Frames written for saved clips")
+        self.clips_saved = self.metrics.counter(
+            'clips_saved', "Clips saved")
+        self.metrics.gauge('extraction_queue_depth',
+                           "Extraction jobs queued or running",
+                           self.pending_extractions)
+
+        if self.config.get('metrics_port'):
+            try:
+                self.metrics.serve(self.config['metrics_port'])
+            except OSError:
+                logger.exception("Could not serve metrics")
+        interval = self.config.get('stats_interval', 60)
+        if interval:
+            GLib.timeout_add_seconds(interval, self.report_stats)
+
+    def report_stats(self):
+        logger.info("Stats: %s", self.metrics.summary())
+        if self.config.get('metrics_file'):
+            try:
+                self.metrics.write(self.config['metrics_file'])
+            except OSError:
+                logger.exception("Could not write metrics")
+        return True
 
-        self.clips_processing = []
-        self.current_scene_start = 0
-        self.next_scene_start = 0
-        self.record_current_scene = False
+    def start_background_services(self):
+        self.processed_clip_ids.start()
+        thread = threading.Thread(target=self.start_writer,
+                                  name='clip-writer')
+        thread.daemon = True
+        thread.start()
+        return False
 
-        self.split_sub_lines = False
+    def on_clip_ids_loaded(self):
+        self.engine.pick_deferred()
+        self.invalidate_overlay()
+        return False
 
-        self.processed_clip_ids = common.data_utils.get_clip_ids()
-        self.writer = common.data_utils.ClipWriter()
+    def start_job_queue(self):
+        self.jobs = jobqueue.open_queue(
+            self.config['job_queue'],
+            self.config.get('job_owner') or jobqueue.default_owner(
+                self.config_file),
+            self.config.get('job_max_attempts', 3))
+        # Adding clips can wait for other processes' transactions
+        self.job_adder = jobqueue.JobAdder(
+            self.jobs, lambda jobs, added: GLib.idle_add(
+                self.on_jobs_added, jobs, added))
+        name = socket.gethostname() + ':' + str(os.getpid())
+        for i in range(self.config.get('job_local_workers', 1)):
+            worker = jobqueue.Worker(
+                self.jobs, self.config, name + '/' + str(i),
+                self.config.get('extraction_batch_size', 16),
+                self.config.get('job_lease_seconds', 60))
+            self.job_threads.append(worker.start())
+            self.job_workers.append(worker)
+        GLib.timeout_add_seconds(2, self.collect_jobs)
+
+    def on_jobs_added(self, jobs, added):
+        self.engine.jobs_added(jobs, added)
+        return False
+
+    def collect_jobs(self):
+        # The queue can be slow or locked, so collect off the main loop,
+        # one collect at a time
+        if self.job_collector is None or not self.job_collector.is_alive():
+            self.job_collector = threading.Thread(
+                target=self.collect_finished_jobs, name='job-collector')
+            self.job_collector.daemon = True
+            self.job_collector.start()
+        return True
+
+    def collect_finished_jobs(self):
+        try:
+            finished = self.jobs.collect()
+        except sqlite3.Error:
+            logger.exception("Could not collect finished jobs")
+            return
+        if len(finished):
+            # Saved on the main loop, like extracted clips
+            self.extracted_jobs.put(finished)
+            GLib.idle_add(self.save_extracted_clips)
+
+    def load_clip_ids(self):
+        import common.data_utils  # Slow to import, only load it when needed
+        return common.data_utils.get_clip_ids()
+
+    def start_writer(self):
+        try:
+            import common.data_utils
+            self.writer = common.data_utils.ClipWriter()
+        except Exception:
+            logger.exception("Could not start the clip writer")
+        finally:
+            self.writer_ready.set()
+            GLib.idle_add(self.write_clips)
+
+    def write_clips(self, clips=()):
+        """Send clips to the writer, or keep them until it's ready."""
+        self.unwritten_clips.extend(clips)
+        if not self.writer_ready.is_set():
+            return False
+        if self.writer is not None:
+            for clip in self.unwritten_clips:
+                self.writer.send(clip)
+        self.unwritten_clips = []
+        return False
 
     def build_ui(self):
         self.window = Gtk.Window(Gtk.WindowType.TOPLEVEL)
@@ -88,6 +281,9 @@ class Main:
         self.accelerators.connect(
             Gdk.keyval_from_name('D'), Gdk.ModifierType.CONTROL_MASK, 0,
             self.seek_to_previous_scene)
+        self.accelerators.connect(
+            Gdk.keyval_from_name('T'), Gdk.ModifierType.CONTROL_MASK, 0,
+            self.on_toggle_draw_time)
         self.window.add_accel_group(self.accelerators)
 
         vbox = Gtk.VBox()
@@ -115,6 +311,12 @@ class Main:
         self.subtitle_label = Gtk.Label("...")
         vbox.pack_start(self.subtitle_label, False, False, 2)
 
+        self.scene_progress = Gtk.ProgressBar()
+        self.scene_progress.set_text("Detecting scenes")
+        self.scene_progress.set_show_text(True)
+        self.scene_progress.set_no_show_all(True)
+        vbox.pack_start(self.scene_progress, False, False, 2)
+
         hbox = Gtk.HBox()
         hbox.set_border_width(10)
         vbox.pack_start(hbox, False, False, 2)
@@ -166,6 +368,8 @@ class Main:
         self.slider.set_draw_value(False)
         self.slider_update_signal_id = self.slider.connect(
             'value-changed', self.on_slider_changed)
+        self.slider.connect('button-press-event', self.on_slider_pressed)
+        self.slider.connect('button-release-event', self.on_slider_released)
         hbox.pack_start(self.slider, True, True, 2)
         GLib.timeout_add(1000, self.update_slider)
 
@@ -180,7 +384,10 @@ class Main:
 
         # Set up video output bin
         # (GhostPad:sink) my-video-bin
-        #     (queue > cairooverlay > videoconvert > autovideosink)
+        #     (queue > [videoscale > capsfilter >] cairooverlay > videoconvert
+        #      > autovideosink)
+        # The optional scaler shrinks frames to the window size before they
+        # are drawn on and converted.
         self.gst_video_bin = Gst.Bin.new('my-video-bin')
 
         self.gst_video_queue = Gst.ElementFactory.make('queue')
@@ -189,7 +396,19 @@ class Main:
         self.gst_overlay = Gst.ElementFactory.make('cairooverlay')
         self.gst_overlay.connect('draw', self.on_draw_scale_preview)
         self.gst_video_bin.add(self.gst_overlay)
-        self.gst_video_queue.link(self.gst_overlay)
+
+        if self.config.get('preview_downscale', True):
+            self.gst_preview_scale = Gst.ElementFactory.make('videoscale')
+            self.gst_video_bin.add(self.gst_preview_scale)
+            self.gst_video_queue.link(self.gst_preview_scale)
+
+            self.gst_preview_caps = Gst.ElementFactory.make('capsfilter')
+            self.gst_video_bin.add(self.gst_preview_caps)
+            self.gst_preview_scale.link(self.gst_preview_caps)
+            self.gst_preview_caps.link(self.gst_overlay)
+        else:
+            self.gst_preview_caps = None
+            self.gst_video_queue.link(self.gst_overlay)
 
         self.gst_convert = Gst.ElementFactory.make('videoconvert')
         self.gst_video_bin.add(self.gst_convert)
@@ -200,6 +419,12 @@ class Main:
         self.gst_convert.link(self.gst_video_sink)
 
         self.gst_video_sink_pad = self.gst_video_queue.get_static_pad('sink')
+        if self.config.get('in_process_extraction', False):
+            self.build_capture_branch()
+            self.gst_video_sink_pad = self.gst_video_tee.get_static_pad('sink')
+        else:
+            self.capture = None
+
         self.gst_video_ghost_pad = Gst.GhostPad.new(
             'sink', self.gst_video_sink_pad)
         self.gst_video_ghost_pad.set_active(True)
@@ -219,6 +444,66 @@ class Main:
         bus.connect('message::state-changed', self.on_state_changed)
         bus.connect('sync-message::element', self.on_sync_message)
 
+    def build_capture_branch(self):
+        # Split off decoded frames before the preview is scaled:
+        # (GhostPad:sink) my-video-bin
+        #     tee > (queue > ... preview as above)
+        #     tee > queue > valve > videoconvert > capsfilter > appsink
+        # The valve only lets frames through while recording.
+        self.gst_video_tee = Gst.ElementFactory.make('tee')
+        self.gst_video_bin.add(self.gst_video_tee)
+        self.gst_video_tee.link(self.gst_video_queue)
+
+        self.gst_capture_queue = Gst.ElementFactory.make('queue')
+        self.gst_video_bin.add(self.gst_capture_queue)
+        self.gst_video_tee.link(self.gst_capture_queue)
+
+        self.gst_capture_valve = Gst.ElementFactory.make('valve')
+        self.gst_capture_valve.set_property('drop', True)
+        self.gst_video_bin.add(self.gst_capture_valve)
+        self.gst_capture_queue.link(self.gst_capture_valve)
+
+        self.gst_capture_convert = Gst.ElementFactory.make('videoconvert')
+        self.gst_video_bin.add(self.gst_capture_convert)
+        self.gst_capture_valve.link(self.gst_capture_convert)
+
+        self.gst_capture_caps = Gst.ElementFactory.make('capsfilter')
+        self.gst_capture_caps.set_property(
+            'caps', Gst.Caps.from_string('video/x-raw,format=RGB'))
+        self.gst_video_bin.add(self.gst_capture_caps)
+        self.gst_capture_convert.link(self.gst_capture_caps)
+
+        self.gst_capture_sink = Gst.ElementFactory.make('appsink')
+        self.gst_capture_sink.set_property('emit-signals', True)
+        self.gst_capture_sink.set_property('sync', False)
+        # Don't wait for a preroll frame the closed valve never lets through
+        self.gst_capture_sink.set_property('async', False)
+        self.gst_capture_sink.connect('new-sample', self.on_capture_sample)
+        self.gst_video_bin.add(self.gst_capture_sink)
+        self.gst_capture_caps.link(self.gst_capture_sink)
+
+        self.capture = capture.FrameCapture(
+            self.config.get('capture_workers'),
+            self.config.get('capture_history', 16),
+            self.config.get('capture_queue_size'))
+
+    def set_capturing(self, capturing):
+        if self.capture is None:
+            return
+        self.gst_capture_valve.set_property('drop', not capturing)
+
+    def finish_capture(self):
+        # Runs on a background thread
+        if not self.capture.join(10):
+            logger.warning("Capture didn't finish, failing the clips left")
+        GLib.idle_add(self.stop_capture)
+
+    def stop_capture(self):
+        if not self.engine.recording:
+            self.set_capturing(False)
+            self.capture.flush()
+        return False
+
     def gst_play(self):
         response = self.gst_pipeline.set_state(Gst.State.PLAYING)
         if response == Gst.StateChangeReturn.FAILURE:
@@ -231,39 +516,36 @@ class Main:
             print("ERROR: Could not pause")
             self.gst_pipeline.set_state(Gst.State.NULL)
 
-    def clip_id(self):
-        filename = os.path.basename(self.filename)
-        return (filename.split('.')[-2].split('-')[-1] +
-                str(self.current_subtitle_start))
-
-    def clip_is_processed(self, id):
-        if id in self.clips_processing:
-            return True
-
-        if id in self.processed_clip_ids:
-            return True
-
+    def invalidate_overlay(self, *args):
+        self.overlay_version += 1
         return False
 
-    def current_clip_alignment(self):
-        current_scene, next_scene, _ = self.get_scene()
+    def overlay_state(self, current_time):
+        version = self.overlay_version
+        picker = self.engine
+        started = time.perf_counter()
+        scene_low, scene_high = picker.scenes.span(current_time)
 
-        if current_scene is not None:
-            self.current_scene_start = float(current_scene['pkt_pts_time'])
-            self.next_scene_start = float(next_scene['pkt_pts_time'])
+        alignment = picker.alignment(current_time)
+        self.scene_lookup_time.observe(time.perf_counter() - started)
+        alpha = 1.0 if alignment == 0 else 0.3
 
-        current_subtitle_end = (self.current_subtitle_start +
-                                self.current_subtitle_duration) / Gst.SECOND
-        current_subtitle_start = self.current_subtitle_start / Gst.SECOND
-
-        if current_subtitle_end >= self.next_scene_start:
-            return 1
-        elif current_subtitle_start < self.current_scene_start:
-            return -1
+        if picker.recording:
+            color = (1.0, 0.0, 0.0, 0.8 * alpha)
+        elif picker.is_processed(picker.clip_id()):
+            color = (.54, .9, .05, 0.7 * alpha)
         else:
-            return 0
+            color = (1.0, 1.0, 1.0, 0.7 * alpha)
+
+        center_x, center_y = picker.center
+        edge_length = picker.detection_scale * 128
+        return OverlayState(version, scene_low, scene_high, center_x,
+                            center_y, center_x - edge_length / 2,
+                            center_y - edge_length / 2, edge_length, alpha,
+                            color)
 
     def update_slider(self):
+        self.seeks.poll()
         if self.gst_state == Gst.State.NULL or self.gst_state == Gst.State.READY:
             # Disable slider when not playing
             self.slider.handler_block(self.slider_update_signal_id)
@@ -272,6 +554,8 @@ class Main:
 
         if self.gst_state != Gst.State.PLAYING:
             return True
+        if self.scrubbing or self.seeks.busy:
+            return True  # Don't move the slider away from the pointer
 
         response, duration = self.gst_src.query_duration(Gst.Format.TIME)
         if not response:
@@ -293,159 +577,114 @@ class Main:
         return True
 
     def save_current_scene(self):
-        print("Saving current scene")
+        logger.debug("Saving current scene")
 
-        # Get current playback position
-        response, position = self.gst_src.query_position(Gst.Format.TIME)
-        if not response:
-            raise Exception("Could not get playback position")
-        current_time = float(position) / Gst.SECOND
-
-        current_scene, next_scene, _ = self.get_scene(current_time=current_time)
-
-        if current_scene is not None:
-            # Seek to start of scene
-            self.current_scene_start = float(current_scene['pkt_pts_time'])
-            self.next_scene_start = float(next_scene['pkt_pts_time'])
+        current_time = self.get_position()
+        response, duration = self.gst_src.query_duration(Gst.Format.TIME)
+        duration = float(duration) / Gst.SECOND if response else None
 
-            print("Current scene start: " + str(self.current_scene_start))
-            print("Next scene start: " + str(self.next_scene_start))
-            print("Position: " + str(current_time))
+        if self.engine.frame_size is None:
+            self.update_video_margin()
+        seek = self.engine.record_scene(current_time, duration)
+        if not self.engine.recording:
+            return  # Picked from the subtitle index
 
+        if seek is not None:
             # Go to the start of the current scene
-            self.gst_src.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH,
-                                     self.current_scene_start * Gst.SECOND)
-        else:
-            # Start recording at the current point
-            self.current_scene_start = current_time
-
-            if next_scene is not None:
-                # Set the next scene if there's one
-                self.next_scene_start = float(next_scene['pkt_pts_time'])
-            else:
-                # Set next scene to end of file
-                response, duration = (
-                    self.gst_src.query_duration(Gst.Format.TIME))
-                if not response:
-                    raise Exception("Could not get video duration")
-                self.next_scene_start = float(duration) / Gst.SECOND
-
-        # Skip until the first subtitle completely within the scene is started
-        self.record_current_scene = True
+            self.seek_to(seek)
         self.record_button.handler_block(self.record_button_clicked_id)
         self.record_button.set_active(True)
         self.record_button.handler_unblock(self.record_button_clicked_id)
-
-        shutil.copyfile(self.config_file, self.config_file + '.bak-'
-                        + datetime.datetime.now().isoformat())
-
-        # Save clip
-        # Go to the next subtitle
-        # Keep saving clips until the current clip ends after the current scene
+        self.set_capturing(True)
 
     def pick(self):
-        # Find the current position
+        if self.engine.frame_size is None:
+            self.update_video_margin()
+        self.engine.pick()
+
+    def extract_batch(self):
+        self.engine.extract_batch()
+
+    def submit_job(self, job):
+        self.unsubmitted_jobs.append(job)
+        self.submit_jobs()
+
+    def submit_jobs(self, block=False):
+        """Submit the jobs that didn't fit in the extraction queue."""
+        while self.unsubmitted_jobs:
+            try:
+                self.extraction.submit(self.unsubmitted_jobs[0], block)
+            except queue.Full:
+                return False
+            self.unsubmitted_jobs.popleft()
+        return False
+
+    def pending_extractions(self):
+        return self.extraction.pending() + len(self.unsubmitted_jobs)
+
+    def save_clip(self, job):
+        if isinstance(job, extraction.ExtractionJob):
+            self.extraction_time.observe(job.duration)
+
+        extracted = self.engine.finish_job(job)
+        for clip, frames in extracted:
+            # Store the results in the JSON data file
+            self.journal.append(clip)
+            self.frames_written.inc(frames)
+            self.clips_saved.inc()
+        self.write_clips([clip for clip, _ in extracted])
+
+    def save_extracted_clips(self):
+        while True:
+            try:
+                job = self.extracted_jobs.get_nowait()
+            except queue.Empty:
+                return False
+            self.save_clip(job)
+
+    def get_position(self):
         response, position = self.gst_src.query_position(Gst.Format.TIME)
         if not response:
             raise Exception("Could not get playback position")
-
-        # Find the start and endpoints of the current subtitle
-        start = float(self.current_subtitle_start) / Gst.SECOND
-        duration = float(self.current_subtitle_duration) / Gst.SECOND
-
-        # Extract the image sequence for this subtitle with ffmpeg
-        subprocess.check_call('mkdir -p ' + self.config['image_root'], shell=True)
-        command = [
-            'ffmpeg',
-            '-loglevel', 'quiet',
-            '-ss', str(start),
-            '-t', str(duration),
-            '-i', self.filename,
-            os.path.join(
-                os.getcwd(),
-                self.config['image_root'] + self.clip_id() + '-%6d' + self.config['image_extension']
-            )
-        ]
-        logging.info(" ".join([pipes.quote(c) for c in command]))
-        subprocess.Popen(command, shell=False)
-
-        # Store the results in the JSON data file
-        self.save_clip()
-
-    def save_clip(self, config_file='config.json'):
-        id = self.clip_id()
-        if self.clip_is_processed(id):
-            logging.info("Clip is already processed. Not saving.")
-            return
-        self.clips_processing.append(id)
-
-        framerate = self.framerate
-        start = math.floor(float(self.current_subtitle_start) * framerate /
-                           Gst.SECOND)
-        duration = math.ceil(float(self.current_subtitle_duration) * framerate
-                             / Gst.SECOND)
-        if duration <= 15:
-            logging.info("Clip is too short. Skipping.")
-            return  # Skip if shorter than 15 frames
-
-        clip = {
-            'id': id,
-            'start': start,
-            'end': start + duration,
-            'scale': self.detection_scale,
-            'center': list(self.center_position),
-            'points_2d': [],
-            'points_3d': [],
-            'subtitle': self.current_subtitle
-        }
-
-        self.config['clips'].append(clip)
-        self.writer.send(clip)
-
-        self.clips_processing.remove(id)
-        self.processed_clip_ids.append(id)
+        return float(position) / Gst.SECOND
 
     def get_scene(self, current_time=None):
+        started = time.perf_counter()
         if current_time is None:
-            # Get current playback position
-            response, position = self.gst_src.query_position(Gst.Format.TIME)
-            if not response:
-                raise Exception("Could not get playback position")
-            current_time = float(position) / Gst.SECOND
+            current_time = self.get_position()
 
         # Get current scene start point
         # Get next scene start point
-        current_scene = None
-        next_scene = None
-        previous_scene = None
-        for i, scene in enumerate(self.scenes):
-            if float(scene['pkt_pts_time']) > float(current_time):
-                next_scene = scene
-                if i > 0:
-                    current_scene = self.scenes[i-1]
-                if i > 1:
-                    previous_scene = self.scenes[i-2]
-                break
-
-        return current_scene, next_scene, previous_scene
-
-    def seek_to(self, seconds):
-        self.gst_src.seek_simple(
-            Gst.Format.TIME,
-            (Gst.SeekFlags.FLUSH |
-             Gst.SeekFlags.ACCURATE),
-            seconds * Gst.SECOND
-        )
+        scene = self.engine.scene_at(current_time)
+        self.scene_lookup_time.observe(time.perf_counter() - started)
+        return scene
+
+    def seek_to(self, seconds, accurate=True):
+        # Seeks requested before the last one is done are coalesced
+        self.seeks.request(seconds, accurate)
+
+    def start_seek(self, seconds, accurate):
+        if accurate:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        else:
+            # Only decode the nearest keyframe while scrubbing
+            flags = (Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT |
+                     Gst.SeekFlags.SNAP_NEAREST)
+        return self.gst_src.seek_simple(Gst.Format.TIME, flags,
+                                        seconds * Gst.SECOND)
 
     def seek_to_next_scene(self, *args):
-        _, next_scene, _ = self.get_scene()
+        # Relative to pending seeks, so repeated jumps add up
+        current_time = self.seeks.position(self.get_position())
+        _, next_scene, _ = self.get_scene(current_time)
         if next_scene is not None:
-            self.seek_to(float(next_scene['pkt_pts_time']))
+            self.seek_to(next_scene)
 
     def seek_to_previous_scene(self, *args):
-        _, _, previous_scene = self.get_scene()
+        current_time = self.seeks.position(self.get_position())
+        _, _, previous_scene = self.get_scene(current_time)
         if previous_scene is not None:
-            self.seek_to(float(previous_scene['pkt_pts_time']))
+            self.seek_to(previous_scene)
 
     def update_video_margin(self):
         if not self.gst_src:
@@ -466,6 +705,12 @@ class Main:
             raise Exception("Could not get video height")
         height = height.value
 
+        if self.proxy is not None:
+            self.source_scale = float(width) / self.proxy.width
+            self.engine.frame_size = (self.proxy.width, self.proxy.height)
+        else:
+            self.source_scale = 1.0
+            self.engine.frame_size = (width, height)
         window_width, window_height = self.window_size
 
         # Calculate resizing
@@ -479,12 +724,42 @@ class Main:
             int((window_height - float(height) * scale) / 2),
         )
 
+        self.update_preview_size(width, height)
+
+    def update_preview_size(self, width, height):
+        if self.gst_preview_caps is None:
+            return
+
+        # Never scale up, and keep the size even for subsampled formats
+        scale = min(self.video_scale, 1.0)
+        preview_size = (max(2, int(width * scale) // 2 * 2),
+                        max(2, int(height * scale) // 2 * 2))
+        # The overlay draws in preview pixels, clips are stored in video
+        # pixels. Rounding to even sizes changes the ratios a little.
+        self.preview_scale = min(float(preview_size[0]) / float(width),
+                                 float(preview_size[1]) / float(height))
+
+        if preview_size != self.preview_size:
+            self.preview_size = preview_size
+            self.gst_preview_caps.set_property('caps', Gst.Caps.from_string(
+                'video/x-raw,width={0},height={1}'.format(*preview_size)))
+
     def set_center_position(self, position):
-        self.center_position = position
+        self.engine.center = position
 
     def on_slider_changed(self, slider_widget, data=None):
         position = slider_widget.get_value()
-        self.seek_to(position)
+        self.seek_to(position, accurate=not self.scrubbing)
+
+    def on_slider_pressed(self, slider_widget, event):
+        self.scrubbing = True
+        return False
+
+    def on_slider_released(self, slider_widget, event):
+        # End up exactly where the slider was released
+        self.scrubbing = False
+        self.seek_to(slider_widget.get_value())
+        return False
 
     def on_realize_video_window(self, video_widget):
         window = video_widget.get_property('window')
@@ -499,21 +774,128 @@ class Main:
         response = dialog.run()
 
         if response == Gtk.ResponseType.OK:
-            self.filename = dialog.get_filename()
-            self.gst_src.set_property('uri', 'file://' + self.filename)
+            filename = dialog.get_filename()
+            self.engine.open(filename)
+            # Play a subtitle file next to the video instead of the
+            # embedded track, the index is made from the same subtitles
+            subtitle_file = subtitles.find_subtitle_file(filename)
+            self.subtitle_file = subtitle_file
+            self.proxy = None
+            if self.config.get('proxy', False):
+                self.proxy = proxy.find_proxy(
+                    self.config.get('proxy_dir', 'proxies'), filename)
+                if self.proxy is None:
+                    thread = threading.Thread(target=self.load_proxy,
+                                              args=(filename,),
+                                              name='proxy-loader')
+                    thread.daemon = True
+                    thread.start()
+            self.set_source()
             self.gst_play()
 
-            if not os.path.isfile(self.filename + '.json'):
-                print("WARNING: Expected scene info file " + self.filename
-                      + '.json, but none was found.')
-            else:
-                with open(self.filename + '.json') as probe_file:
-                    self.scenes = json.load(probe_file)['frames']
+            thread = threading.Thread(target=self.load_scenes,
+                                      args=(filename,),
+                                      name='scene-loader')
+            thread.daemon = True
+            thread.start()
+            if self.config.get('index_subtitles', True):
+                thread = threading.Thread(target=self.load_subtitles,
+                                          args=(filename, subtitle_file),
+                                          name='subtitle-loader')
+                thread.daemon = True
+                thread.start()
         elif response == Gtk.ResponseType.CANCEL:
             print("Cancelled file dialog")
 
         dialog.destroy()
 
+    def set_source(self):
+        """Play the proxy of the open video if there is one."""
+        path = self.engine.filename
+        subtitle_file = self.subtitle_file
+        if self.proxy is not None:
+            path = self.proxy.path
+            subtitle_file = subtitle_file or self.proxy.subtitles
+        self.gst_src.set_property('uri', 'file://' + path)
+        self.gst_src.set_property(
+            'suburi', subtitle_file and 'file://' + subtitle_file)
+
+        # Captured frames would be the proxy's
+        self.engine.capture = self.capture if self.proxy is None else None
+        self.engine.frame_size = None
+
+    def load_proxy(self, filename):
+        # Runs on a background thread
+        try:
+            made = proxy.load_proxy(self.config, filename)
+        except Exception:
+            logger.exception("Could not make a proxy of " + filename)
+            return
+        GLib.idle_add(self.on_proxy_ready, filename, made)
+
+    def on_proxy_ready(self, filename, made):
+        if filename != self.engine.filename:
+            return False
+        logger.info("Switching to proxy %s", made.path)
+
+        # Continue at the same position once the proxy is prerolled
+        try:
+            position = self.get_position()
+        except Exception:
+            position = 0.0
+        self.resume_position = (position,
+                                self.gst_state == Gst.State.PLAYING)
+        self.gst_pipeline.set_state(Gst.State.READY)
+        self.proxy = made
+        self.set_source()
+        self.gst_pipeline.set_state(Gst.State.PAUSED)
+        return False
+
+    def load_scenes(self, filename):
+        # Runs on a background thread
+        def progress(fraction):
+            GLib.idle_add(self.on_scene_progress, filename, fraction)
+
+        try:
+            index = scenes.load_scene_index(
+                filename, threshold=self.config.get('scene_threshold', 0.4),
+                progress=progress)
+        except Exception:
+            logger.exception("Could not load scenes for " + filename)
+            index = None
+        GLib.idle_add(self.on_scenes_loaded, filename, index)
+
+    def on_scene_progress(self, filename, fraction):
+        if filename == self.engine.filename:
+            self.scene_progress.show()
+            self.scene_progress.set_fraction(fraction)
+        return False
+
+    def on_scenes_loaded(self, filename, index):
+        if filename == self.engine.filename:
+            self.scene_progress.hide()
+            if index is not None:
+                logger.info("Loaded %d scenes", len(index))
+                self.engine.set_scenes(index)
+        return False
+
+    def load_subtitles(self, filename, subtitle_file=None):
+        # Runs on a background thread. Without the index, record mode
+        # falls back to the subtitles shown during playback.
+        try:
+            index = subtitles.SubtitleIndex(subtitles.load_subtitles(
+                filename, subtitle_file))
+        except Exception:
+            logger.exception("Could not index the subtitles of " + filename)
+            index = None
+        GLib.idle_add(self.on_subtitles_loaded, filename, index)
+
+    def on_subtitles_loaded(self, filename, index):
+        if filename == self.engine.filename and index is not None:
+            logger.info("Indexed %d subtitles", len(index))
+            self.engine.set_subtitle_index(index)
+        return False
+
     def on_click_play(self, widget, data=None):
         if self.gst_state == Gst.State.PLAYING:
             self.gst_pause()
@@ -529,110 +911,204 @@ class Main:
     def on_click_pick(self, widget, data=None):
         self.pick()
 
+    def stop_recording(self):
+        self.engine.stop_recording()
+        self.record_button.handler_block(self.record_button_clicked_id)
+        self.record_button.set_active(False)
+        self.record_button.handler_unblock(self.record_button_clicked_id)
+        if self.capture is not None:
+            # The capture branch may still be behind on the last clip
+            thread = threading.Thread(target=self.finish_capture,
+                                      name='capture-finish')
+            thread.daemon = True
+            thread.start()
+
     def on_click_record(self, *args, **kwargs):
-        if self.record_current_scene:
-            self.record_current_scene = False
-            self.record_button.handler_block(self.record_button_clicked_id)
-            self.record_button.set_active(False)
-            self.record_button.handler_unblock(self.record_button_clicked_id)
+        if self.engine.recording:
+            self.stop_recording()
         else:
             self.save_current_scene()
 
     def on_subtitle_sample(self, sink, data):
+        # Runs on the streaming thread: only copy the subtitle out of the
+        # buffer and leave the rest to the main loop
         sample = sink.emit('pull-sample')
         buf = sample.get_buffer()
 
         subtitle = buf.extract_dup(0, buf.get_size()).decode('UTF-8')
+        GLib.idle_add(self.on_subtitle, subtitle, buf.pts, buf.duration,
+                      time.perf_counter())
 
-        if self.split_sub_lines:
-            self.current_subtitle = subtitle.split('\n')[-1]
-        else:
-            self.current_subtitle = subtitle.replace('\n', ' ')
-
-        self.subtitle_label.set_markup(self.current_subtitle)
-
-        self.current_subtitle_duration = buf.duration
-        self.current_subtitle_start = buf.pts
-
-        # If recording current scene, save the clip
-        if self.record_current_scene:
-            print("Maybe recording this clip")
-
-            alignment = self.current_clip_alignment()
-            if alignment == 1:
-                print("Clip subtitles end after current scene")
-                self.record_current_scene = False
-                self.record_button.handler_block(self.record_button_clicked_id)
-                self.record_button.set_active(False)
-                self.record_button.handler_unblock(
-                    self.record_button_clicked_id)
-            elif alignment == -1:
-                print("Clip subtitles start before current scene")
-            else:
-                print("Saving current clip")
-                self.pick()
+        return Gst.FlowReturn.OK
 
-        return False
+    def on_subtitle(self, subtitle, start, duration, received=None):
+        if received is not None:
+            self.subtitle_latency.observe(time.perf_counter() - received)
+
+        # While recording, the engine saves the clip if it's in the scene
+        recording = self.engine.recording
+        current_time = None
+        if recording:
+            current_time = self.get_position()
+        self.engine.set_subtitle(subtitle, start, duration, current_time)
+        self.subtitle_label.set_markup(self.engine.subtitle)
+
+        if recording and not self.engine.recording:
+            self.stop_recording()
+
+        return False  # Only run once
 
     def on_video_window_click(self, widget, event):
         x = (float(event.x) - self.video_margin[0]) / self.video_scale
         y = (float(event.y) - self.video_margin[1]) / self.video_scale
-        self.center_position = (x, y)
+        self.engine.center = (x / self.source_scale, y / self.source_scale)
+        self.invalidate_overlay()
 
     def on_toggle_sub_split(self, widget):
-        self.split_sub_lines = widget.get_active()
+        self.engine.split_sub_lines = widget.get_active()
+
+    def on_toggle_draw_time(self, *args):
+        self.show_draw_time = not self.show_draw_time
 
     def on_video_window_scroll(self, widget, event):
-        self.detection_scale -= 0.16 * event.delta_y
+        self.engine.detection_scale -= 0.16 * event.delta_y
+        self.invalidate_overlay()
 
     def on_video_window_resize(self, widget, rectangle):
         self.window_size = (rectangle.width, rectangle.height)
         self.update_video_margin()
 
     def on_draw_scale_preview(self, overlay, draw, timestamp, duration):
-        center_x = self.center_position[0]
-        center_y = self.center_position[1]
-        top_x = center_x - self.detection_scale * 64
-        top_y = center_y - self.detection_scale * 64
-        edge_length = self.detection_scale * 128
-        alpha = 1.0 if self.current_clip_alignment() == 0 else 0.3
+        started = time.perf_counter()
+
+        # Only recompute the overlay when its inputs changed or playback
+        # moved into another scene
+        current_time = float(timestamp) / Gst.SECOND
+        state = self.overlay
+        if (state is None or state.version != self.overlay_version or
+                not state.scene_low <= current_time < state.scene_high):
+            state = self.overlay = self.overlay_state(current_time)
+
+        # The overlay is in video pixels, drawn on preview pixels. Only the
+        # shapes are scaled, lines and text keep their width.
+        scale = self.preview_scale * self.source_scale
+
+        def shapes():
+            draw.save()
+            draw.scale(scale, scale)
+            draw.rectangle(state.top_x, state.top_y, state.edge_length,
+                           state.edge_length)
+            draw.rectangle(state.center_x, state.center_y, 2, 2)
+            draw.restore()
 
         draw.save()
-
-        draw.rectangle(top_x, top_y, edge_length, edge_length)
-        draw.rectangle(center_x, center_y, 2, 2)
-
         draw.set_tolerance(0.1)
+        shapes()
         draw.set_line_width(5)
-        draw.set_source_rgba(0.0, 0.0, 0.0, 0.3 * alpha)
+        draw.set_source_rgba(0.0, 0.0, 0.0, 0.3 * state.alpha)
         draw.stroke()
 
-        draw.rectangle(top_x, top_y, edge_length, edge_length)
-        draw.rectangle(center_x, center_y, 2, 2)
-
+        shapes()
         draw.set_line_width(2)
-        if self.record_current_scene:
-            draw.set_source_rgba(1.0, 0.0, 0.0, 0.8 * alpha)
-        elif self.clip_is_processed(self.clip_id()):
-            draw.set_source_rgba(.54, .9, .05, 0.7 * alpha)
-        else:
-            draw.set_source_rgba(1.0, 1.0, 1.0, 0.7 * alpha)
+        draw.set_source_rgba(*state.color)
         draw.stroke()
 
+        elapsed = time.perf_counter() - started
+        self.draw_timer.add(elapsed)
+        self.draw_time.observe(elapsed)
+        if self.show_draw_time:
+            draw.set_source_rgba(1.0, 1.0, 1.0, 0.8)
+            draw.set_font_size(24)
+            draw.move_to(10, 34)
+            draw.show_text(str(self.draw_timer))
+
         draw.restore()
 
+    def on_capture_sample(self, sink):
+        # Runs on the capture branch's streaming thread
+        sample = sink.emit('pull-sample')
+        buf = sample.get_buffer()
+        structure = sample.get_caps().get_structure(0)
+        width = structure.get_value('width')
+        height = structure.get_value('height')
+
+        # RGB rows are padded to a multiple of 4 bytes
+        stride = (width * 3 + 3) // 4 * 4
+        self.capture.push(capture.Frame(buf.pts, width, height, stride,
+                                        buf.extract_dup(0, buf.get_size())))
+        return Gst.FlowReturn.OK
+
+    def on_clip_extracted(self, job):
+        # Called from an extraction worker, save on the main loop
+        self.extracted_jobs.put(job)
+        GLib.idle_add(self.save_extracted_clips)
+        if isinstance(job, extraction.ExtractionJob):
+            GLib.idle_add(self.submit_jobs)
+
     def on_quit(self, widget, event, data=None):
         logger.info("Stopping pipeline")
         self.gst_pipeline.set_state(Gst.State.NULL)
+        if self.capture is not None:
+            self.capture.close()
+        self.extract_batch()
+        logger.info("Waiting for %d frame extractions",
+                    self.pending_extractions())
+        self.submit_jobs(block=True)
+        self.extraction.close()
+        self.save_extracted_clips()
+        if self.jobs is not None:
+            # Let running extractions finish and collect them; jobs still
+            # leased after that are left to the other workers
+            for worker in self.job_workers:
+                worker.stop()
+            logger.info("Waiting for %d job workers", len(self.job_threads))
+            deadline = time.monotonic() + 10
+            if not self.job_adder.close(deadline - time.monotonic()):
+                logger.warning("Clips are still being added to the job "
+                               "queue")
+            threads = self.job_threads + [self.job_collector]
+            for thread in threads:
+                if thread is not None:
+                    thread.join(max(0, deadline - time.monotonic()))
+            if any(thread is not None and thread.is_alive()
+                   for thread in threads):
+                logger.warning("Job workers still running, closing the "
+                               "job queue anyway")
+            self.collect_finished_jobs()
+            self.save_extracted_clips()
+            self.jobs.close()
         logger.info("Closing clip writer")
-        self.writer.close()
+        if self.writer_ready.wait(10):
+            self.write_clips()
+            if self.writer is not None:
+                self.writer.close()
+        logger.info("Compacting clip journal")
+        self.journal.close()
+        logger.info("Stats: %s", self.metrics.summary())
+        if self.config.get('metrics_file'):
+            try:
+                self.metrics.write(self.config['metrics_file'])
+            except OSError:
+                logger.exception("Could not write metrics")
+        self.metrics.close()
         return False  # Don't cancel quit
 
     def on_message(self, bus, message):
         t = message.type
         if t == Gst.MessageType.EOS:
+            if self.capture is not None:
+                self.capture.flush(complete=True)
             self.gst_pipeline.set_state(Gst.State.NULL)
             self.play_button.set_label("Play")
+        elif t == Gst.MessageType.ASYNC_DONE:
+            # Also posted when a flushing seek is done
+            self.seeks.done()
+            if self.resume_position is not None:
+                position, playing = self.resume_position
+                self.resume_position = None
+                self.seek_to(position)
+                if playing:
+                    self.gst_play()
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
             print("Error: " + str(err))
@@ -651,7 +1127,7 @@ class Main:
         if self.gst_state == Gst.State.PAUSED:
             pad = self.gst_src.emit('get-video-pad', 0)
             response = pad.get_current_caps().get_structure(0).get_fraction('framerate')
-            self.framerate = float(response[1]) / float(response[2])
+            self.engine.framerate = float(response[1]) / float(response[2])
 
         if self.gst_state == Gst.State.PLAYING:
             self.update_video_margin()
@@ -669,6 +1145,7 @@ class Main:
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     GObject.threads_init()
     Gtk.init(sys.argv)
     Gst.init(sys.argv)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Counters, gauges and timers for the hot paths of the picker
+
+Updating a metric only takes a lock and an addition, so they can be used
+in draw callbacks and streaming threads. The values are reported as a stats
+log line, and optionally in the Prometheus text format, in a file or on a
+local HTTP endpoint.
+"""
+
+import http.server
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    """Total that only goes up, like frames written."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.reported = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def families(self):
+        """(name, type, help, samples) of the Prometheus metrics."""
+        return [(self.name, 'counter', self.help,
+                 [(self.name + '_total', self.value)])]
+
+    def summary(self, elapsed):
+        with self.lock:
+            delta = self.value - self.reported
+            self.reported = self.value
+        return "{0} {1:.1f}/s".format(self.name, delta / elapsed)
+
+
+class Gauge:
+    """Current value, set or read from function when reported."""
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def families(self):
+        return [(self.name, 'gauge', self.help, [(self.name, self.get())])]
+
+    def summary(self, elapsed):
+        return "{0} {1}".format(self.name, self.get())
+
+
+class Timer:
+    """Durations in seconds: count, total and the maximum since reported."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.reported = (0, 0.0)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def families(self):
+        return [(self.name, 'summary', self.help,
+                 [(self.name + '_count', self.count),
+                  (self.name + '_sum', self.total)]),
+                (self.name + '_max', 'gauge',
+                 self.help + ", maximum since the last stats line",
+                 [(self.name + '_max', self.max)])]
+
+    def summary(self, elapsed):
+        with self.lock:
+            count = self.count - self.reported[0]
+            total = self.total - self.reported[1]
+            maximum = self.max
+            self.reported = (self.count, self.total)
+            self.max = 0.0
+        if not count:
+            return self.name + " -"
+        return "{0} {1:.2f}/{2:.2f} ms avg/max ({3})".format(
+            self.name, 1000 * total / count, 1000 * maximum, count)
+
+
+class Metrics:
+    """Named metrics, with their stats line and Prometheus text."""
+
+    def __init__(self, prefix='picker_'):
+        self.prefix = prefix
+        self.metrics = []
+        self.reported = time.time()
+        self.server = None
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self.add(Gauge(name, help, function))
+
+    def timer(self, name, help):
+        return self.add(Timer(name, help))
+
+    def summary(self):
+        """One line with every metric since the last summary."""
+        now = time.time()
+        elapsed = max(now - self.reported, 1e-9)
+        self.reported = now
+        return ", ".join(metric.summary(elapsed)[len(self.prefix):]
+                         for metric in self.metrics)
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            for family, kind, help, samples in metric.families():
+                lines.append('# HELP ' + family + ' ' + help)
+                lines.append('# TYPE ' + family + ' ' + kind)
+                for name, value in samples:
+                    lines.append(name + ' ' + repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the Prometheus text to a file, for a textfile collector."""
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(temporary, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the Prometheus text on http://host:port/metrics."""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes would flood the log
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='metrics-server')
+        thread.daemon = True
+        thread.start()
+        logger.info("Serving metrics on http://%s:%d/metrics", host,
+                    self.server.server_address[1])
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Packed store for the frames of many clips in one file
+
+The frames of every clip are appended, as they are (encoded images or raw
+frames), to one data file per video. An index file next to it records the
+offset and length of every frame by clip id, so readers can mmap the data
+file and slice frames without copying them.
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Frame files as written by ffmpeg for clips.image_pattern: <id>-%06d<ext>
+FRAME_FILE = re.compile(r'^(.*)-\s*(\d+)(\.\w+)$')
+
+
+class PackedFrameStore:
+    """Frames of clips, stored in path with their index in path + '.idx'."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.lock = threading.Lock()
+        self.index = {}
+        self.data = None
+        self.map = None
+        self.load_index()
+
+    def load_index(self):
+        self.index = {}
+        if not os.path.isfile(self.index_path):
+            return
+        with open(self.index_path, encoding='UTF-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line, its frames are not indexed
+                self.index[entry['id']] = entry['frames']
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def ids(self):
+        return list(self.index)
+
+    def append_clip(self, id, frames):
+        """Store the frames (bytes-like) of a clip, replacing earlier ones."""
+        with self.lock:
+            with open(self.path, 'ab') as data:
+                offset = data.seek(0, os.SEEK_END)
+                entries = []
+                for frame in frames:
+                    data.write(frame)
+                    entries.append([offset, len(frame)])
+                    offset += len(frame)
+                data.flush()
+                os.fsync(data.fileno())
+
+            # Only index the clip once its frames are on disk
+            with open(self.index_path, 'a', encoding='UTF-8') as index:
+                index.write(json.dumps({'id': id, 'frames': entries}) + '\n')
+                index.flush()
+                os.fsync(index.fileno())
+            self.index[id] = entries
+
+            # Map again to see the new data. Frames handed out before keep
+            # the old map alive.
+            self.map = None
+            self.data = None
+
+    def append_files(self, id, paths, delete=False):
+        frames = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                frames.append(f.read())
+        self.append_clip(id, frames)
+        if delete:
+            for path in paths:
+                os.remove(path)
+
+    def _open_map(self):
+        if self.map is None:
+            self.data = open(self.path, 'rb')
+            self.map = mmap.mmap(self.data.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        return self.map
+
+    def frames(self, id):
+        """memoryviews of the frames of a clip, backed by the mmap."""
+        view = memoryview(self._open_map())
+        return [view[offset:offset + length]
+                for offset, length in self.index[id]]
+
+    def frame(self, id, number):
+        """One frame of a clip, numbered from 1 like the image files."""
+        offset, length = self.index[id][number - 1]
+        return memoryview(self._open_map())[offset:offset + length]
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # Frames are still in use, it closes when they're gone
+            self.data.close()
+            self.map = None
+            self.data = None
+
+
+def frame_files(image_root, prefix='', extension=None):
+    """Frame paths, in order, by clip id for the image files in a directory.
+
+    Only clips whose id starts with prefix and frames with the given
+    extension are included.
+    """
+    clips = {}
+    for name in os.listdir(image_root):
+        match = FRAME_FILE.match(name)
+        if not match:
+            continue
+        id, number, ext = match.groups()
+        if not id.startswith(prefix):
+            continue
+        if extension is not None and ext != extension:
+            continue
+        clips.setdefault(id, []).append((int(number),
+                                         os.path.join(image_root, name)))
+
+    return dict((id, [path for _, path in sorted(frames)])
+                for id, frames in clips.items())
+
+
+def convert(image_root, store_path, prefix='', extension=None,
+            delete=False):
+    """Pack the image sequences in image_root into a store."""
+    store = PackedFrameStore(store_path)
+    clips = frame_files(image_root, prefix, extension)
+    for i, (id, paths) in enumerate(sorted(clips.items())):
+        if id in store:
+            continue
+        store.append_files(id, paths, delete)
+        logger.info("[%d/%d] Packed %d frames of %s", i + 1, len(clips),
+                    len(paths), id)
+    store.close()
+    return len(clips)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pack the frames in an image directory into one file")
+    parser.add_argument('image_root')
+    parser.add_argument('store', help="packed file to create or add to")
+    parser.add_argument('--prefix', default='',
+                        help="only pack clips whose id starts with this, "
+                        "like the video part of the clip ids")
+    parser.add_argument('--extension', help="only pack frames with this "
+                        "extension, like .png")
+    parser.add_argument('--delete', action='store_true',
+                        help="delete the frame files once they are packed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    convert(args.image_root, args.store, args.prefix, args.extension,
+            args.delete)
+
+
+if __name__ == '__main__':
+    main()
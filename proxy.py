@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+Cache of small, keyframe-dense proxies of videos for fast seeking
+
+A proxy is a low resolution copy of a video in which every frame (or every
+few frames) is a keyframe, so seeking in it never has to decode a long
+group of pictures. Proxies are only played: clips are still extracted from
+the original video at the same timestamps.
+
+Like subtitle indexes, scene detection and extraction, which all use
+ffmpeg, proxies count time from the start of their source, so positions
+in a proxy are positions in the source even when it doesn't start at 0.
+
+Proxies are stored in one directory, named by a hash of the source path,
+size and mtime, so a changed source gets a new proxy. Every proxy has a
+JSON sidecar with the size of its source, and the embedded subtitles of
+the source are stored next to it as SRT, for playback. When the directory
+grows above its size limit, the least recently used proxies are deleted.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+
+import scenes
+import subtitles
+
+logger = logging.getLogger(__name__)
+
+# Line in the ffmpeg log with the size of the source's video stream
+VIDEO_SIZE = re.compile(r'Stream #0:\d+.*: Video: .*?, (\d{2,5})x(\d{2,5})')
+
+# A cached proxy, the frame size of the video it was made from and its
+# subtitles (None if the source has no subtitle track)
+Proxy = collections.namedtuple('Proxy', ['path', 'width', 'height',
+                                         'subtitles'])
+
+# Files of a proxy: the video, the sidecar and its subtitles
+PROXY_FILES = ('.mkv', '.json', '.srt')
+
+
+def proxy_key(filename):
+    """Cache key for the current version of a video."""
+    stat = os.stat(filename)
+    source = '{0}\0{1}\0{2}'.format(os.path.abspath(filename), stat.st_size,
+                                    stat.st_mtime_ns)
+    return hashlib.sha1(source.encode('UTF-8')).hexdigest()
+
+
+def find_proxy(directory, filename):
+    """The cached Proxy of a video, or None. Marks it as recently used."""
+    path = os.path.join(directory, proxy_key(filename))
+    try:
+        with open(path + '.json') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.isfile(path + '.mkv'):
+        return None
+
+    os.utime(path + '.mkv')
+    return Proxy(path + '.mkv', info['width'], info['height'],
+                 info.get('subtitles'))
+
+
+def make_proxy(directory, filename, height=360, gop=1, progress=None):
+    """Transcode a video into the cache and return its Proxy.
+
+    The proxy is at most height pixels high and has a keyframe every gop
+    frames. progress is called with the fraction done so far.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, proxy_key(filename))
+    partial = path + '.partial.mkv'
+    command = [
+        'ffmpeg',
+        '-nostdin',
+        '-y',
+        '-hide_banner',
+        '-nostats',
+        '-loglevel', 'info',
+        '-progress', 'pipe:2',
+        '-i', filename,
+        '-map', '0:v:0', '-map', '0:a:0?', '-sn',
+        '-vf', "scale=-2:'min({0},ih)'".format(height),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'fastdecode',
+        '-crf', '28', '-g', str(gop), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '96k',
+        partial
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+
+    size = None
+    duration = None
+    log = collections.deque(maxlen=20)
+    for line in process.stderr:
+        line = line.decode('UTF-8', 'replace')
+        log.append(line)
+
+        match = scenes.PROGRESS_TIME.match(line)
+        if match and duration and progress is not None:
+            progress(min(1.0, int(match.group(1)) / 1e6 / duration))
+            continue
+
+        match = scenes.DURATION.search(line)
+        if match and duration is None:
+            hours, minutes, seconds = match.groups()
+            duration = (int(hours) * 60 + int(minutes)) * 60 + float(seconds)
+            continue
+
+        match = VIDEO_SIZE.search(line)
+        if match and size is None:
+            size = (int(match.group(1)), int(match.group(2)))
+
+    if process.wait() != 0 or size is None:
+        if os.path.isfile(partial):
+            os.remove(partial)
+        raise Exception("Could not make a proxy of " + filename + ": "
+                        + ''.join(log).strip())
+
+    # Subtitles in any format as text, so playbin can show them with the
+    # proxy like with the source
+    subtitle_path = None
+    try:
+        text = subtitles.extract_srt(filename)
+        subtitle_path = path + '.srt'
+        with open(subtitle_path, 'w', encoding='UTF-8') as f:
+            f.write(text)
+    except subprocess.CalledProcessError:
+        pass  # No subtitle track
+
+    os.replace(partial, path + '.mkv')
+    with open(path + '.json', 'w') as f:
+        json.dump({'source': os.path.abspath(filename), 'width': size[0],
+                   'height': size[1], 'subtitles': subtitle_path}, f)
+    return Proxy(path + '.mkv', size[0], size[1], subtitle_path)
+
+
+def evict(directory, limit, keep=()):
+    """Delete the least recently used proxies above limit bytes.
+
+    The size of a proxy includes its sidecar and subtitles. Proxies in keep
+    are never deleted.
+    """
+    if not os.path.isdir(directory):
+        return
+
+    proxies = []
+    used = 0
+    for name in os.listdir(directory):
+        if not name.endswith('.mkv') or name.endswith('.partial.mkv'):
+            continue
+        path = os.path.join(directory, name)
+        stat = os.stat(path)
+        size = stat.st_size
+        for extension in PROXY_FILES[1:]:
+            try:
+                size += os.path.getsize(path[:-len('.mkv')] + extension)
+            except OSError:
+                pass
+        proxies.append((stat.st_mtime, path, size))
+        used += size
+
+    for _, path, size in sorted(proxies):
+        if used <= limit:
+            break
+        if path in keep:
+            continue
+        logger.info("Evicting proxy %s", path)
+        for extension in PROXY_FILES:
+            name = path[:-len('.mkv')] + extension
+            if os.path.isfile(name):
+                os.remove(name)
+        used -= size
+
+
+def load_proxy(config, filename, progress=None):
+    """Cached or new proxy of a video, using the proxy settings in config."""
+    directory = config.get('proxy_dir', 'proxies')
+    cached = find_proxy(directory, filename)
+    if cached is not None:
+        return cached
+
+    logger.info("Making a proxy of %s", filename)
+    made = make_proxy(directory, filename, config.get('proxy_height', 360),
+                      config.get('proxy_gop', 1), progress)
+    evict(directory, config.get('proxy_cache_mb', 20000) * 1024 * 1024,
+          keep=(made.path,))
+    return made
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make playback proxies of videos ahead of time")
+    parser.add_argument('videos', nargs='+')
+    parser.add_argument('--config', default='config.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config) as f:
+        config = json.load(f)
+    for filename in args.videos:
+        print(load_proxy(config, filename).path)
+
+
+if __name__ == '__main__':
+    main()
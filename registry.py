@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Registry of processed clip ids
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ClipRegistry:
+    """Set of clip ids that are already saved.
+
+    The ids are loaded with load() on a background thread, which calls
+    on_loaded() when done. Until then, membership checks only see the ids
+    added since; call wait() first where a stale answer is not acceptable.
+    """
+
+    def __init__(self, load=None, on_loaded=None):
+        self.load = load
+        self.on_loaded = on_loaded
+        self.ids = set()
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        if load is None:
+            self.loaded.set()
+
+    def start(self):
+        if self.loaded.is_set():
+            return
+        thread = threading.Thread(target=self.load_ids, name='clip-registry')
+        thread.daemon = True
+        thread.start()
+
+    def load_ids(self):
+        try:
+            ids = set(self.load())
+        except Exception:
+            logger.exception("Could not load processed clip ids")
+            ids = set()
+
+        with self.lock:
+            ids |= self.ids
+            self.ids = ids
+        logger.info("Loaded %d processed clip ids", len(ids))
+        self.loaded.set()
+        if self.on_loaded is not None:
+            self.on_loaded()
+
+    def wait(self, timeout=None):
+        return self.loaded.wait(timeout)
+
+    def add(self, id):
+        with self.lock:
+            self.ids.add(id)
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
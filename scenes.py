@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""
+Scene boundary index for video-picker
+"""
+
+import array
+import bisect
+import logging
+import os
+import re
+import struct
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# Sidecar cache: magic, source file size, source mtime (ns), detection
+# threshold and width (0 for ffprobe files), scene count, followed by the
+# scene start times as doubles
+CACHE_MAGIC = b'VPSCENE2'
+CACHE_HEADER = struct.Struct('<8sqqdqq')
+
+PTS_TIME = re.compile(rb'"pkt_pts_time"\s*:\s*"?([-+0-9.eE]+)')
+
+# Lines in the ffmpeg log while detecting scenes
+DURATION = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+SHOWINFO_TIME = re.compile(
+    r'\bn:\s*\d+\s+pts:\s*-?\d+\s+pts_time:([-+0-9.eE]+)')
+PROGRESS_TIME = re.compile(r'^out_time_(?:us|ms)=(\d+)')
+
+
+class SceneIndex:
+    """Sorted scene start times (in seconds) with fast position lookup."""
+
+    def __init__(self, timestamps=()):
+        self.timestamps = array.array('d', sorted(timestamps))
+
+        # Interval [low, high) and index of the last lookup. Playback moves
+        # forward slowly, so most lookups land in the same interval again.
+        self._last_hit = (0.0, -1.0, 0)
+
+    @classmethod
+    def from_frames(cls, frames):
+        return cls(float(frame['pkt_pts_time']) for frame in frames)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def index_of(self, current_time):
+        """Index of the first scene starting strictly after current_time."""
+        low, high, i = self._last_hit
+        if low <= current_time < high:
+            return i
+
+        timestamps = self.timestamps
+        i = bisect.bisect_right(timestamps, current_time)
+        if i < len(timestamps):
+            low = timestamps[i - 1] if i > 0 else float('-inf')
+            self._last_hit = (low, timestamps[i], i)
+        return i
+
+    def lookup(self, current_time):
+        """Return (current, next, previous) scene start times.
+
+        Any of them is None when it doesn't exist. Like the original linear
+        scan, all three are None once current_time is past the last scene.
+        """
+        timestamps = self.timestamps
+        i = self.index_of(current_time)
+        if i >= len(timestamps):
+            return None, None, None
+
+        current_scene = timestamps[i - 1] if i > 0 else None
+        previous_scene = timestamps[i - 2] if i > 1 else None
+        return current_scene, timestamps[i], previous_scene
+
+    def span(self, current_time):
+        """Times [low, high) around current_time with the same lookup()."""
+        timestamps = self.timestamps
+        i = self.index_of(current_time)
+        low = timestamps[i - 1] if i > 0 else float('-inf')
+        high = timestamps[i] if i < len(timestamps) else float('inf')
+        return low, high
+
+    def interval(self, current_time, end_time):
+        """Return (start, end) of the scene containing current_time.
+
+        The video start and end_time bound the first and last scenes.
+        """
+        timestamps = self.timestamps
+        i = self.index_of(current_time)
+        start = timestamps[i - 1] if i > 0 else 0.0
+        end = timestamps[i] if i < len(timestamps) else end_time
+        return start, end
+
+    def intervals(self, end_time):
+        """Yield (start, end) of every scene, as interval() returns them."""
+        start = 0.0
+        for timestamp in self.timestamps:
+            if timestamp > start:
+                yield start, timestamp
+            start = timestamp
+        if end_time > start:
+            yield start, end_time
+
+
+def read_probe_timestamps(probe_path, chunk_size=1 << 20):
+    """Scene start times from ffprobe -show_frames JSON output.
+
+    Streams the file and only keeps the pkt_pts_time of every frame, so
+    large probe files never have to be loaded as a whole.
+    """
+    timestamps = array.array('d')
+    tail = b''
+    with open(probe_path, 'rb') as probe_file:
+        while True:
+            chunk = probe_file.read(chunk_size)
+            data = tail + chunk
+            end = 0
+            for match in PTS_TIME.finditer(data):
+                if chunk and match.end() == len(data):
+                    break  # The number may continue in the next chunk
+                timestamps.append(float(match.group(1)))
+                end = match.end()
+            if not chunk:
+                return timestamps
+            tail = data[max(end, len(data) - 64):]
+
+
+def write_cache(cache_path, source_path, timestamps, threshold=0.0,
+                width=0):
+    stat = os.stat(source_path)
+    temporary_path = cache_path + '.tmp'
+    try:
+        with open(temporary_path, 'wb') as cache_file:
+            cache_file.write(CACHE_HEADER.pack(
+                CACHE_MAGIC, stat.st_size, stat.st_mtime_ns, threshold,
+                width, len(timestamps)))
+            timestamps.tofile(cache_file)
+        os.replace(temporary_path, cache_path)
+    except OSError as e:
+        logger.warning("Could not write scene cache %s: %s", cache_path, e)
+
+
+def read_cache(cache_path, source_path, threshold=0.0, width=0):
+    """Cached scene start times, or None if missing or out of date.
+
+    threshold and width are the detect_scenes parameters they were made
+    with, 0 for ffprobe files.
+    """
+    try:
+        stat = os.stat(source_path)
+        with open(cache_path, 'rb') as cache_file:
+            header = cache_file.read(CACHE_HEADER.size)
+            if len(header) != CACHE_HEADER.size:
+                return None
+            (magic, size, mtime, cached_threshold, cached_width,
+             count) = CACHE_HEADER.unpack(header)
+            if (magic != CACHE_MAGIC or size != stat.st_size or
+                    mtime != stat.st_mtime_ns or
+                    cached_threshold != threshold or cached_width != width):
+                return None
+            timestamps = array.array('d')
+            timestamps.fromfile(cache_file, count)
+            return timestamps
+    except (OSError, EOFError):
+        return None
+
+
+def detect_scenes(filename, threshold=0.4, width=160, progress=None):
+    """Scene start times of a video, detected with ffmpeg's scene filter.
+
+    Frames are downscaled to the given width first, which is plenty to
+    compare them and much faster. progress is called with the fraction of
+    the video analyzed so far.
+    """
+    command = [
+        'ffmpeg',
+        '-nostdin',
+        '-hide_banner',
+        '-nostats',
+        '-loglevel', 'info',
+        '-progress', 'pipe:2',
+        '-i', filename,
+        '-an', '-sn', '-dn',
+        '-vf', "scale={0}:-2,select='gt(scene,{1})',showinfo".format(
+            width, threshold),
+        '-f', 'null',
+        '-'
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+
+    timestamps = array.array('d')
+    duration = None
+    for line in process.stderr:
+        line = line.decode('UTF-8', 'replace')
+
+        match = SHOWINFO_TIME.search(line)
+        if match:
+            timestamps.append(float(match.group(1)))
+            continue
+
+        match = PROGRESS_TIME.match(line)
+        if match and duration and progress is not None:
+            progress(min(1.0, int(match.group(1)) / 1e6 / duration))
+            continue
+
+        match = DURATION.search(line)
+        if match and duration is None:
+            hours, minutes, seconds = match.groups()
+            duration = (int(hours) * 60 + int(minutes)) * 60 + float(seconds)
+
+    if process.wait() != 0:
+        raise Exception("Scene detection failed for " + filename
+                        + ": ffmpeg exited with code "
+                        + str(process.returncode))
+    return timestamps
+
+
+def load_scene_index(filename, detect=True, threshold=0.4, width=160,
+                     progress=None):
+    """Scene index for a video.
+
+    Uses the ffprobe scene file filename + '.json' when there is one.
+    Otherwise, scenes are detected with detect_scenes() if detect is set,
+    or None is returned. Either way, the start times are cached in
+    filename + '.scenes', keyed by the size and mtime of their source and
+    the detection parameters, so every video is only parsed or analyzed
+    once.
+    """
+    probe_path = filename + '.json'
+    cache_path = filename + '.scenes'
+    source_path = probe_path if os.path.isfile(probe_path) else filename
+    if source_path == probe_path:
+        threshold, width = 0.0, 0
+    else:
+        threshold, width = float(threshold), int(width)
+
+    timestamps = read_cache(cache_path, source_path, threshold, width)
+    if timestamps is not None:
+        return SceneIndex(timestamps)
+
+    if source_path == probe_path:
+        index = SceneIndex(read_probe_timestamps(probe_path))
+    elif detect:
+        logger.info("No scene info file %s, detecting scenes in %s",
+                    probe_path, filename)
+        index = SceneIndex(detect_scenes(filename, threshold, width,
+                                         progress))
+    else:
+        return None
+
+    write_cache(cache_path, source_path, index.timestamps, threshold, width)
+    return index
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Seek scheduling for the picker: one seek at a time, the latest target wins
+"""
+
+import time
+
+
+class SeekScheduler:
+    """Runs seeks one at a time, coalescing the ones requested meanwhile.
+
+    seek(position, accurate) starts a seek in the player. The player calls
+    done() when it finished (for GStreamer, on ASYNC_DONE). Seeks requested
+    while one is running replace each other, so only the latest target is
+    seeked to once the player is ready again. A seek that doesn't report
+    back within timeout seconds is considered done.
+    """
+
+    def __init__(self, seek, timeout=1.0):
+        self.seek = seek
+        self.timeout = timeout
+        self.started = None
+        self.target = None
+        self.pending = None
+
+    @property
+    def busy(self):
+        return (self.started is not None and
+                time.monotonic() - self.started < self.timeout)
+
+    def position(self, current_time):
+        """Where playback will be once the seeks are done."""
+        if self.pending is not None:
+            return self.pending[0]
+        if self.busy:
+            return self.target
+        return current_time
+
+    def request(self, position, accurate=True):
+        """Seek to position (seconds), now or when the running seek is done.
+
+        Fast seeks go to a nearby keyframe, accurate seeks to the exact
+        position.
+        """
+        if self.busy:
+            self.pending = (position, accurate)
+            return False
+        self._start(position, accurate)
+        return True
+
+    def done(self):
+        self.started = None
+        if self.pending is not None:
+            position, accurate = self.pending
+            self.pending = None
+            self._start(position, accurate)
+
+    def poll(self):
+        """Start the pending seek if the running one timed out."""
+        if self.pending is not None and not self.busy:
+            self.done()
+
+    def _start(self, position, accurate):
+        self.target = position
+        if self.seek(position, accurate):
+            self.started = time.monotonic()
+        else:
+            self.started = None
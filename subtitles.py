@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Subtitle loading for video-picker, without a running pipeline
+"""
+
+import array
+import bisect
+import os
+import re
+import subprocess
+
+import clips
+from clips import SECOND
+
+# Subtitle files next to a video, in order of preference
+SUBTITLE_EXTENSIONS = ('.srt', '.ass', '.ssa', '.vtt')
+
+SRT_TIMING = re.compile(
+    r'(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)')
+
+
+def _timestamp(hours, minutes, seconds, fraction):
+    # Scale the fraction to nanoseconds, whatever its number of digits
+    nanoseconds = int(fraction.ljust(9, '0')[:9])
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * SECOND \
+        + nanoseconds
+
+
+def parse_srt(text):
+    """Yield (start, duration, text) for every SRT cue, in nanoseconds."""
+    text = text.lstrip('\ufeff').replace('\r\n', '\n')
+    for block in re.split(r'\n\s*\n', text):
+        lines = block.strip('\n').split('\n')
+        for i, line in enumerate(lines):
+            match = SRT_TIMING.search(line)
+            if match:
+                break
+        else:
+            continue
+
+        start = _timestamp(*match.groups()[:4])
+        end = _timestamp(*match.groups()[4:])
+        yield start, end - start, '\n'.join(lines[i + 1:])
+
+
+def extract_srt(filename, stream=0):
+    """Convert a subtitle file or embedded subtitle stream to SRT text."""
+    command = [
+        'ffmpeg',
+        '-loglevel', 'quiet',
+        '-i', filename,
+        '-map', '0:s:' + str(stream),
+        '-f', 'srt',
+        '-'
+    ]
+    return subprocess.check_output(command).decode('UTF-8')
+
+
+def load_subtitles(filename, subtitle_file=None, stream=0):
+    """Subtitles for a video, sorted by start time.
+
+    Reads subtitle_file when given (SRT directly, anything else through
+    ffmpeg), otherwise the embedded subtitle track of the video.
+    """
+    if subtitle_file is None:
+        text = extract_srt(filename, stream)
+    elif subtitle_file.lower().endswith('.srt'):
+        with open(subtitle_file, encoding='UTF-8', errors='replace') as f:
+            text = f.read()
+    else:
+        text = extract_srt(subtitle_file)
+
+    return sorted(parse_srt(text))
+
+
+def find_subtitle_file(filename):
+    """Subtitle file with the same name as a video, or None."""
+    base = os.path.splitext(filename)[0]
+    for extension in SUBTITLE_EXTENSIONS:
+        if os.path.isfile(base + extension):
+            return base + extension
+    return None
+
+
+class SubtitleIndex:
+    """Subtitles of a video, indexed by start time.
+
+    Holds the start and end times (nanoseconds) in sorted arrays, so the
+    subtitles of a scene are found without playing it.
+    """
+
+    def __init__(self, subtitle_list=()):
+        subtitle_list = sorted(subtitle_list)
+        self.starts = array.array('q', [s[0] for s in subtitle_list])
+        self.ends = array.array('q', [s[0] + s[1] for s in subtitle_list])
+        self.texts = [s[2] for s in subtitle_list]
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, i):
+        return (self.starts[i], self.ends[i] - self.starts[i], self.texts[i])
+
+    def within(self, scene_start, next_scene_start):
+        """(start, duration, text) of the subtitles completely in a scene.
+
+        Scene times are in seconds. Uses the same rule as record mode,
+        clips.clip_alignment.
+        """
+        # One nanosecond of slack for the rounding, alignment decides
+        low = bisect.bisect_left(self.starts, int(scene_start * SECOND) - 1)
+        high = bisect.bisect_left(self.starts,
+                                  int(next_scene_start * SECOND) + 1)
+        return [self[i] for i in range(low, high)
+                if clips.clip_alignment(self.starts[i],
+                                        self.ends[i] - self.starts[i],
+                                        scene_start, next_scene_start) == 0]
+
+
+def format_subtitle(subtitle, split_sub_lines=False):
+    if split_sub_lines:
+        return subtitle.split('\n')[-1]
+    else:
+        return subtitle.replace('\n', ' ')